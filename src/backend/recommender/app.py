@@ -1,18 +1,37 @@
 from dotenv import load_dotenv, find_dotenv
 load_dotenv(find_dotenv())
 
-import os, re, base64, io, json, tempfile, urllib.parse
-from typing import Dict, List, Optional
+import os, re, base64, io, json, gzip, time, queue, secrets, threading, tempfile, urllib.parse
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 from PIL import Image
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
+from werkzeug.exceptions import RequestEntityTooLarge
 from google.cloud import firestore, storage
 import requests
 
 from google import genai
-from model import ArtifactIndex, ClipQueryEncoder, FaissSearcher
+
+try:
+    import orjson
+except ImportError:  # falls back to stdlib json
+    orjson = None
+try:
+    import brotli
+except ImportError:  # gzip only
+    brotli = None
+from concepts import NAME_RE as CONCEPT_NAME_RE, ConceptImageStore
+from filters import (
+    TYPE_ALIASES, _normalize, _norm_any, _type_matches, _norm_token,
+    _collect_size_tokens, _collect_color_tokens, _size_match_score, _color_match_score,
+)
+from mirror import ProductMirror, image_candidates
+from model import ArtifactIndex, ClipQueryEncoder, FaissSearcher, InferencePool, PoolOverloaded
+from online import OnlineIndex
 
 # -----------------------------------------------------------------------------
 # Credentials init
@@ -42,11 +61,50 @@ _ensure_gcp_credentials()
 PROJECT_ID = os.getenv("GCP_PROJECT") or os.getenv("FIREBASE_PROJECT") or ""
 GCS_BUCKET = os.getenv("GCS_BUCKET", "")
 SIGNED_URL_EXPIRY = int(os.getenv("SIGNED_URL_EXPIRY", "3600"))
+SIGNED_URL_CACHE_MAX = int(os.getenv("SIGNED_URL_CACHE_MAX", "20000"))
+PRODUCT_MIRROR = os.getenv("PRODUCT_MIRROR", "1") == "1"
 PORT = int(os.getenv("PORT", "5000"))
 CORS_ALLOWED_ORIGIN = os.getenv("CORS_ALLOWED_ORIGIN", "http://localhost:5173")
 
 SUITABILITY_THRESHOLD = 0.68
 
+# Bounded inference pool (see model.InferencePool)
+INFERENCE_SLOTS = int(os.getenv("INFERENCE_SLOTS", "2"))
+INFERENCE_MAX_QUEUE = int(os.getenv("INFERENCE_MAX_QUEUE", "16"))
+INFERENCE_DEADLINE_S = float(os.getenv("INFERENCE_DEADLINE_S", "5"))
+
+# Room photo uploads (multipart "image" part or raw image/* body)
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+MAX_IMAGE_SIDE = int(os.getenv("MAX_IMAGE_SIDE", "1024"))   # JPEG draft decode target
+
+# "Load more" cursors (server-side ranked lists, per process)
+CURSOR_TTL_S = int(os.getenv("CURSOR_TTL_S", "600"))
+CURSOR_MAX_ENTRIES = int(os.getenv("CURSOR_MAX_ENTRIES", "2000"))
+CURSOR_MAX_BYTES = int(os.getenv("CURSOR_MAX_BYTES", str(64 * 1024 * 1024)))
+
+# Online catalog updates (see online.OnlineIndex; flat index mode only)
+ONLINE_UPDATES = os.getenv("ONLINE_UPDATES", "0") == "1"   # needs a writable artifacts dir (WAL + compaction)
+ONLINE_FEED = os.getenv("ONLINE_FEED", "0") == "1"       # follow Firestore changes through the product mirror
+RECO_ADMIN_TOKEN = os.getenv("RECO_ADMIN_TOKEN", "")     # enables POST /reco/admin/products
+FIREBASE_BUCKET = os.getenv("FIREBASE_BUCKET", "").strip()
+
+# Generated concept images (see concepts.ConceptImageStore)
+# Off unless a backend is configured: responses then keep the data URLs.
+# A local dir only suits a single long-lived instance (on Cloud Run it is
+# per-instance, lost on restart and counted against memory).
+CONCEPT_STORE_BUCKET = os.getenv("CONCEPT_STORE_BUCKET", "")     # store in gs://<bucket>/concepts/
+CONCEPT_STORE_DIR = os.getenv("CONCEPT_STORE_DIR", "")           # or in this local directory
+CONCEPT_STORE_MAX_BYTES = int(os.getenv("CONCEPT_STORE_MAX_BYTES", str(512 * 1024 * 1024)))
+CONCEPT_PUBLIC_BASE = os.getenv("CONCEPT_PUBLIC_BASE", "").rstrip("/")  # URL prefix for image links; forwarded/request origin if empty
+CONCEPT_PATH = "/reco/concepts"
+
+# Response encoding
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "1024"))
+COMPACT_FIELDS = [
+    "id", "name", "price", "imageUrl", "images", "score",
+    "baseType", "categorySlug", "departmentSlug", "colorOptions", "sizeOptions",
+]
+
 # 🚨 INITIALIZE AI KEYS 🚨
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
 gemini_client = genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else None
@@ -54,7 +112,11 @@ gemini_client = genai.Client(api_key=GEMINI_API_KEY) if GEMINI_API_KEY else None
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
 
 app = Flask(__name__)
-CORS(app, origins=[CORS_ALLOWED_ORIGIN], supports_credentials=False)
+# Legacy image_b64 JSON bodies are ~4/3 of the photo size
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_BYTES * 4 // 3 + 64 * 1024
+# Size/timing headers are read by the browser client to compare response shapes
+EXPOSE_HEADERS = ["X-Payload-Bytes", "X-Serialize-Ms"]
+CORS(app, origins=[CORS_ALLOWED_ORIGIN], supports_credentials=False, expose_headers=EXPOSE_HEADERS)
 
 db = firestore.Client(project=PROJECT_ID or None)
 gcs = storage.Client(project=PROJECT_ID or None)
@@ -62,21 +124,72 @@ gcs = storage.Client(project=PROJECT_ID or None)
 art = ArtifactIndex(os.path.join(os.path.dirname(__file__), "artifacts"))
 art.load()
 encoder = ClipQueryEncoder()
+encoder.load_text_cache(os.path.join(art.art_dir, "query_cache.npz"), encode_missing=True)
 searcher = FaissSearcher(art)
+pool = InferencePool(INFERENCE_SLOTS, INFERENCE_MAX_QUEUE, INFERENCE_DEADLINE_S)
 CATALOG: Dict[str, dict] = {m["id"]: m for m in art.mapping_list}
 
+# Live products mirror: hydration without per-item Firestore reads
+mirror: Optional[ProductMirror] = None
+if PRODUCT_MIRROR:
+    mirror = ProductMirror(db.collection("products"))
+    mirror.start()
+
+concept_store: Optional[ConceptImageStore] = None
+if CONCEPT_STORE_BUCKET or CONCEPT_STORE_DIR:
+    concept_store = ConceptImageStore(
+        CONCEPT_STORE_DIR, CONCEPT_STORE_MAX_BYTES,
+        bucket=gcs.bucket(CONCEPT_STORE_BUCKET) if CONCEPT_STORE_BUCKET else None,
+    )
+
+def _fetch_image_bytes(url: str) -> Optional[bytes]:
+    """Lead image bytes for online indexing: gs:// read directly, http(s) fetched."""
+    try:
+        if url.startswith("gs://"):
+            bkt, path = url[5:].split("/", 1)
+            return gcs.bucket(bkt).blob(path).download_as_bytes(timeout=30)
+        r = requests.get(url, timeout=30)
+        r.raise_for_status()
+        return r.content
+    except Exception as e:
+        print(f"Online image fetch failed for {url}: {e}")
+        return None
+
+def _on_catalog_change(pid: str, item: Optional[dict]):
+    if item is None:
+        CATALOG.pop(pid, None)
+    else:
+        CATALOG[pid] = item
+    _partitions_for_type.cache_clear()
+
+# Live index updates, replayed from the WAL on top of the built artifacts
+online: Optional[OnlineIndex] = None
+if ONLINE_UPDATES and art.mode == "flat":
+    online = OnlineIndex(
+        art, encoder, pool, _fetch_image_bytes, on_change=_on_catalog_change,
+        bucket=FIREBASE_BUCKET or None, project=PROJECT_ID or db.project,
+    )
+    try:
+        online.start()
+    except OSError as e:
+        print(f"Online updates disabled, artifacts dir not writable: {e}")
+        online = None
+    CATALOG.clear()
+    CATALOG.update({m["id"]: m for m in art.mapping_list if m.get("id")})
+
 # -----------------------------------------------------------------------------
 # AI Interior Designer Logic (Gemini + OpenRouter Flux)
 # -----------------------------------------------------------------------------
-def analyze_with_gemini(img_b64, text, f_type, size_pref, color_pref, min_b, max_b):
-    try:
-        if not gemini_client:
-            return {"room_analysis": "🚨 DEBUG: No Gemini API Key found!", "custom_concepts": []}
+_PLACEHOLDER_NO_IMAGE = "https://placehold.co/800x600/eeeeee/999999?text=No+Image+Returned"
+_PLACEHOLDER_FAILED = "https://placehold.co/800x600/eeeeee/999999?text=Image+Generation+Failed"
+_PLACEHOLDER_NO_KEY = "https://placehold.co/800x600/eeeeee/999999?text=Missing+OpenRouter+Key"
 
-        contents = []
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+GEMINI_MODEL = "gemini-2.5-flash"
 
-        # 🚨 STRICT ENFORCEMENT PROMPT 🚨
-        prompt = f"""
+def _gemini_prompt(f_type, size_pref, color_pref) -> str:
+    # 🚨 STRICT ENFORCEMENT PROMPT 🚨
+    return f"""
         You are an expert interior designer. A customer is looking for a specific furniture piece.
         
         CRITICAL RULES:
@@ -101,67 +214,157 @@ def analyze_with_gemini(img_b64, text, f_type, size_pref, color_pref, min_b, max
           ]
         }}
         """
-        
-        if img_b64:
-            img_data = base64.b64decode(img_b64)
-            img = Image.open(io.BytesIO(img_data))
-            contents.append(img)
 
-        contents.append(prompt)
+def _gemini_contents(img_b64, f_type, size_pref, color_pref, image: Optional[Image.Image] = None) -> list:
+    contents = []
+    if image is not None:
+        contents.append(image)
+    elif img_b64:
+        img_data = base64.b64decode(img_b64)
+        img = Image.open(io.BytesIO(img_data))
+        contents.append(img)
+    contents.append(_gemini_prompt(f_type, size_pref, color_pref))
+    return contents
+
+def _parse_gemini_json(resp_text: str) -> dict:
+    resp_text = resp_text.strip()
+    start_idx = resp_text.find('{')
+    end_idx = resp_text.rfind('}')
+    json_str = resp_text[start_idx:end_idx+1] if start_idx != -1 and end_idx != -1 else resp_text
+    return json.loads(json_str)
+
+def _concept_image_prompt(concept: dict, f_type, color_pref) -> str:
+    c_title = str(concept.get("title", f_type or "Furniture"))
+    c_color = str(concept.get("suggested_color", color_pref or "Modern"))
+    c_vibe = str(concept.get("background_vibe", "bright minimal luxury room"))
+
+    # Force the category to be exactly what the user picked so Flux doesn't hallucinate
+    c_cat = str(concept.get("category", f_type))
+
+    # Heavily enforced image prompt
+    return f"Professional interior design photography. A perfectly centered, front-facing photorealistic {c_color} {c_cat}. The {c_cat} is perfectly placed inside a room with this exact environment: {c_vibe}. 8k resolution, highly detailed texture, symmetrical."
+
+def _router_request(img_prompt: str) -> Tuple[dict, dict]:
+    """Headers + JSON body for an OpenRouter Flux image generation call."""
+    headers = {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    body = {
+        "model": "black-forest-labs/flux.2-flex",
+        "messages": [{"role": "user", "content": img_prompt}],
+        "modalities": ["image"]
+    }
+    return headers, body
+
+def _router_image_url(data: dict) -> str:
+    message = data['choices'][0]['message']
+    if 'images' in message and len(message['images']) > 0:
+        return message['images'][0]['image_url']['url']
+    return _PLACEHOLDER_NO_IMAGE
+
+def _concept_path(key: str, thumb: bool = False) -> str:
+    return f"{CONCEPT_PATH}/{key}{'.thumb' if thumb else ''}.webp"
+
+def _cached_concept_image(img_prompt: str) -> Optional[str]:
+    """Stored image for a prompt generated before, so repeat views skip OpenRouter."""
+    if concept_store is None:
+        return None
+    try:
+        key = concept_store.lookup_prompt(img_prompt)
+    except Exception as e:
+        print(f"Concept store lookup failed: {e}")
+        return None
+    return _concept_path(key) if key else None
+
+def _store_concept_image(img_prompt: str, url: str) -> str:
+    """
+    Swap a generated base64 data URL for a short store URL. http(s) URLs,
+    placeholders and anything the store rejects are returned unchanged.
+    """
+    if concept_store is None:
+        return url
+    key = concept_store.put_data_url(url)
+    if key is None:
+        return url
+    try:
+        concept_store.remember_prompt(img_prompt, key)
+    except Exception as e:
+        print(f"Concept store prompt index failed: {e}")
+    return _concept_path(key)
+
+def _set_concept_image(concept: dict, url: str):
+    """image_url, plus thumbnail_url for store paths only (never a second copy of a data URL)."""
+    concept["image_url"] = url
+    if url.startswith(CONCEPT_PATH + "/"):
+        concept["thumbnail_url"] = url[:-len(".webp")] + ".thumb.webp"
+    else:
+        concept.pop("thumbnail_url", None)
+
+def _public_base(scheme: str, host: str, headers) -> str:
+    """
+    Origin clients reach us at: CONCEPT_PUBLIC_BASE, else the request's,
+    with X-Forwarded-Proto/-Host (set by Cloud Run and the web proxy) taking
+    precedence over the socket's http://.
+    """
+    if CONCEPT_PUBLIC_BASE:
+        return CONCEPT_PUBLIC_BASE
+    proto = (headers.get("X-Forwarded-Proto") or scheme).split(",")[0].strip()
+    host = (headers.get("X-Forwarded-Host") or host).split(",")[0].strip()
+    return f"{proto}://{host}"
+
+def _absolute_concept_urls(ai_designer_data: Optional[dict], base: str) -> Optional[dict]:
+    """Prefix store paths with the public base URL (see _public_base)."""
+    prefix = base.rstrip("/")
+    for concept in (ai_designer_data or {}).get("custom_concepts") or []:
+        for k in ("image_url", "thumbnail_url"):
+            v = concept.get(k)
+            if isinstance(v, str) and v.startswith(CONCEPT_PATH + "/"):
+                concept[k] = prefix + v
+    return ai_designer_data
+
+def _concept_response(name: str, if_none_match: str) -> Tuple[bytes, int, dict]:
+    """(body, status, headers) for GET /reco/concepts/<name>; shared with asgi.py."""
+    if concept_store is None or not CONCEPT_NAME_RE.match(name or ""):
+        return b"", 404, {}
+    # content-addressed, so the name is a strong validator and never changes
+    headers = {"Cache-Control": ConceptImageStore.CACHE_CONTROL, "ETag": f'"{name}"'}
+    if f'"{name}"' in (if_none_match or ""):
+        return b"", 304, headers
+    data = concept_store.get(name)
+    if data is None:
+        return b"", 404, {"Cache-Control": "no-store"}
+    return data, 200, {**headers, "Content-Type": "image/webp"}
+
+def _generate_concept_image(img_prompt: str) -> str:
+    # 🚨 OPENROUTER IMAGE GENERATION 🚨
+    if not OPENROUTER_API_KEY:
+        return _PLACEHOLDER_NO_KEY
+    cached = _cached_concept_image(img_prompt)
+    if cached:
+        return cached
+    try:
+        headers, body = _router_request(img_prompt)
+        router_res = requests.post(OPENROUTER_URL, headers=headers, json=body, timeout=45)
+        router_res.raise_for_status()
+        return _store_concept_image(img_prompt, _router_image_url(router_res.json()))
+    except Exception as e:
+        print(f"OpenRouter Error: {e}")
+        return _PLACEHOLDER_FAILED
+
+def analyze_with_gemini(img_b64, text, f_type, size_pref, color_pref, min_b, max_b, image=None):
+    try:
+        if not gemini_client:
+            return {"room_analysis": "🚨 DEBUG: No Gemini API Key found!", "custom_concepts": []}
 
         response = gemini_client.models.generate_content(
-            model='gemini-2.5-flash',
-            contents=contents
+            model=GEMINI_MODEL,
+            contents=_gemini_contents(img_b64, f_type, size_pref, color_pref, image=image)
         )
-        
-        resp_text = response.text.strip()
-        start_idx = resp_text.find('{')
-        end_idx = resp_text.rfind('}')
-        json_str = resp_text[start_idx:end_idx+1] if start_idx != -1 and end_idx != -1 else resp_text
-            
-        parsed = json.loads(json_str)
+        parsed = _parse_gemini_json(response.text)
 
-        # 🚨 OPENROUTER IMAGE GENERATION 🚨
         for concept in parsed.get("custom_concepts", []):
-            c_title = str(concept.get("title", f_type or "Furniture"))
-            c_color = str(concept.get("suggested_color", color_pref or "Modern"))
-            c_vibe = str(concept.get("background_vibe", "bright minimal luxury room"))
-            
-            # Force the category to be exactly what the user picked so Flux doesn't hallucinate
-            c_cat = str(concept.get("category", f_type)) 
-            
-            # Heavily enforced image prompt
-            img_prompt = f"Professional interior design photography. A perfectly centered, front-facing photorealistic {c_color} {c_cat}. The {c_cat} is perfectly placed inside a room with this exact environment: {c_vibe}. 8k resolution, highly detailed texture, symmetrical."
-            
-            if OPENROUTER_API_KEY:
-                try:
-                    router_res = requests.post(
-                        "https://openrouter.ai/api/v1/chat/completions",
-                        headers={
-                            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-                            "Content-Type": "application/json"
-                        },
-                        json={
-                            "model": "black-forest-labs/flux.2-flex", 
-                            "messages": [{"role": "user", "content": img_prompt}],
-                            "modalities": ["image"] 
-                        },
-                        timeout=45 
-                    )
-                    router_res.raise_for_status()
-                    data = router_res.json()
-                    
-                    message = data['choices'][0]['message']
-                    if 'images' in message and len(message['images']) > 0:
-                        concept["image_url"] = message['images'][0]['image_url']['url']
-                    else:
-                        concept["image_url"] = "https://placehold.co/800x600/eeeeee/999999?text=No+Image+Returned"
-                    
-                except Exception as e:
-                    print(f"OpenRouter Error: {e}")
-                    concept["image_url"] = "https://placehold.co/800x600/eeeeee/999999?text=Image+Generation+Failed"
-            else:
-                concept["image_url"] = "https://placehold.co/800x600/eeeeee/999999?text=Missing+OpenRouter+Key"
+            _set_concept_image(concept, _generate_concept_image(_concept_image_prompt(concept, f_type, color_pref)))
 
         return parsed
     except Exception as e:
@@ -173,7 +376,25 @@ def analyze_with_gemini(img_b64, text, f_type, size_pref, color_pref, min_b, max
 def _is_valid_bucket(name: str) -> bool:
     return bool(name and re.match(r"^[a-z0-9][a-z0-9._-]{1,61}[a-z0-9]$", name))
 
+_signed_cache: Dict[str, Tuple[str, float]] = {}
+
 def _sign_gs_url(gs_url: str, expiry_seconds: int = SIGNED_URL_EXPIRY) -> Optional[str]:
+    """
+    V4 signed URL for a gs:// object. Results are reused for half their
+    lifetime, so mirrored hydration does not re-sign the same image on
+    every response.
+    """
+    hit = _signed_cache.get(gs_url) if expiry_seconds == SIGNED_URL_EXPIRY else None
+    if hit and hit[1] > time.time():
+        return hit[0]
+    url = _sign_gs_url_uncached(gs_url, expiry_seconds)
+    if url and expiry_seconds == SIGNED_URL_EXPIRY:
+        if len(_signed_cache) > SIGNED_URL_CACHE_MAX:
+            _signed_cache.clear()
+        _signed_cache[gs_url] = (url, time.time() + expiry_seconds / 2)
+    return url
+
+def _sign_gs_url_uncached(gs_url: str, expiry_seconds: int) -> Optional[str]:
     try:
         if not isinstance(gs_url, str) or not gs_url.startswith("gs://"):
             return None
@@ -224,222 +445,131 @@ def _normalize_images(item: dict) -> List[str]:
             out.append(https)
     return out
 
-def _normalize(s: Optional[str]) -> str:
-    return (s or "").strip().lower()
-
-def _norm_any(v) -> str:
-    if v is None:
-        return ""
-    if isinstance(v, list):
-        v = " ".join([str(x) for x in v])
-    return str(v).strip().lower()
-
-def _type_matches(item: dict, f_type: str) -> bool:
-    if not f_type:
-        return True
+@lru_cache(maxsize=256)
+def _partitions_for_type(f_type: str) -> Tuple[str, ...]:
+    """
+    Category sub-indexes to scan for a typed query.
+
+    Picks every slug partition the type (or one of its aliases) points at,
+    then checks that their union holds every row _type_matches() accepts.
+    If some match only by id/name outside those partitions, returns () so
+    the caller keeps using the global index and no match is out of reach.
+    Routed results are not identical to global-then-filter: the search
+    depth is spent inside the partitions, so it returns a deeper candidate
+    set for the type than the global top-k would after filtering.
+    """
+    if not f_type or not art.partitions:
+        return ()
     t = _normalize(f_type)
-    dep  = _norm_any(item.get("departmentSlug"))
-    cat  = _norm_any(item.get("categorySlug"))
-    pid  = _norm_any(item.get("id"))
-    name = _norm_any(item.get("name") or item.get("title"))
-    for field in (dep, cat, pid, name):
-        if t and t in field:
-            return True
-    aliases = {
-        "bed": ["bedroom", "-bed", " bed"],
-        "sofa": ["sofa", " couch", "-sofa"],
-        "chair": ["chair", "-chair"],
-        "table": ["table", "-table", "dining"],
-        "bench": ["bench", "-bench"],
-        "sectional": ["sectional", "-sectional"],
-        "ottoman": ["ottoman", "-ottoman"],
-    }
-    for token in aliases.get(t, []):
-        if token in dep or token in cat or token in pid or token in name:
-            return True
-    return False
+    tokens = [t] + [a.strip(" -") for a in TYPE_ALIASES.get(t, [])]
+    slugs = tuple(s for s in art.partitions if any(tok and tok in s for tok in tokens))
+    if not slugs:
+        return ()
+    covered = set()
+    for s in slugs:
+        covered.update(art.partition_rows[s].tolist())
+    for row in list(art.id2row.values()):
+        if row not in covered and _type_matches(art.row_to_item(row), f_type):
+            return ()
+    return slugs
+
+def _coerce_list(candidates: List[str]) -> List[str]:
+    out, seen = [], set()
+    for u in candidates:
+        https = _coerce_https(u)
+        if https and https not in seen:
+            seen.add(https)
+            out.append(https)
+    return out
 
-def _norm_token(s: str) -> str:
-    return re.sub(r"[^a-z0-9]+", "", (s or "").lower())
-
-def _collect_size_tokens(meta: dict) -> List[str]:
-    tokens: List[str] = []
-    sizes = meta.get("sizeOptions") or []
-    if isinstance(sizes, list):
-        for s in sizes:
-            if isinstance(s, dict):
-                for key in ("label", "name", "id"):
-                    v = s.get(key)
-                    if isinstance(v, str):
-                        tokens.append(v.lower())
-            elif isinstance(s, str):
-                tokens.append(s.lower())
-    sc = meta.get("seatCount")
-    if sc:
-        try:
-            n = int(sc)
-            tokens.append(f"{n} seater")
-            tokens.append(f"{n}-seater")
-        except Exception:
-            pass
-    return tokens
-
-def _collect_color_tokens(meta: dict) -> List[str]:
-    tokens: List[str] = []
-    colors = meta.get("colorOptions") or []
-    if isinstance(colors, list):
-        for c in colors:
-            if isinstance(c, dict):
-                for key in ("label", "name", "id"):
-                    v = c.get(key)
-                    if isinstance(v, str):
-                        tokens.append(v.lower())
-            elif isinstance(c, str):
-                tokens.append(c.lower())
-    tags = meta.get("tags") or []
-    if isinstance(tags, list):
-        tokens.extend(str(t).lower() for t in tags)
-    return tokens
-
-def _size_match_score(meta: dict, pref: str) -> float:
-    if not pref:
-        return 0.0
-    pref_norm = _norm_token(pref)
-    if not pref_norm:
-        return 0.0
-    for t in _collect_size_tokens(meta):
-        if _norm_token(t) == pref_norm:
-            return 1.0
-    return 0.0
-
-def _color_match_score(meta: dict, pref: str) -> float:
-    if not pref:
-        return 0.0
-    pref_norm = _norm_token(pref)
-    if not pref_norm:
-        return 0.0
-    for t in _collect_color_tokens(meta):
-        if _norm_token(t) == pref_norm:
-            return 1.0
-    return 0.0
+def _images_from_product_doc(d: dict, color_pref: Optional[str] = None, size_pref: Optional[str] = None) -> List[str]:
+    """Signed/https image list for a Firestore product dict, preferred option first."""
+    return _coerce_list(image_candidates(d, color_pref=color_pref, size_pref=size_pref))
 
 def _hydrate_images_from_firestore(pid: str, color_pref: Optional[str] = None, size_pref: Optional[str] = None) -> List[str]:
+    if mirror is not None and mirror.ready:
+        cands = mirror.candidates(pid, color_pref, size_pref)
+        return _coerce_list(cands) if cands is not None else []
     try:
         snap = db.collection("products").document(pid).get()
         if not snap.exists:
             return []
-
-        d = snap.to_dict() or {}
-        candidates: List[str] = []
-
-        ibo = d.get("imagesByOption")
-        if isinstance(ibo, dict) and (color_pref or size_pref):
-            color_key = None
-            if color_pref:
-                want = _norm_token(color_pref)
-                for ck in ibo.keys():
-                    if _norm_token(ck) == want:
-                        color_key = ck
-                        break
-
-            if color_key and isinstance(ibo.get(color_key), dict):
-                size_map = ibo[color_key]
-                size_key = None
-                if size_pref:
-                    want_s = _norm_token(size_pref)
-                    for sk in size_map.keys():
-                        if _norm_token(sk) == want_s:
-                            size_key = sk
-                            break
-
-                if size_key and isinstance(size_map.get(size_key), list):
-                    for u in size_map[size_key]:
-                        if isinstance(u, str):
-                            candidates.append(u)
-                else:
-                    for arr in size_map.values():
-                        if isinstance(arr, list):
-                            candidates.extend([u for u in arr if isinstance(u, str)])
-
-        if isinstance(ibo, dict):
-            for color_map in ibo.values():
-                if isinstance(color_map, dict):
-                    for arr in color_map.values():
-                        if isinstance(arr, list):
-                            candidates.extend([u for u in arr if isinstance(u, str)])
-
-        for k in ("thumbnail","imageUrl","image","defaultImagePath","heroImage"):
-            v = d.get(k)
-            if isinstance(v, str):
-                candidates.append(v)
-        imgs = d.get("images")
-        if isinstance(imgs, list):
-            candidates.extend([u for u in imgs if isinstance(u, str)])
-
-        out, seen = [], set()
-        for u in candidates:
-            https = _coerce_https(u)
-            if https and https not in seen:
-                seen.add(https)
-                out.append(https)
-        return out
+        return _images_from_product_doc(snap.to_dict() or {}, color_pref=color_pref, size_pref=size_pref)
     except Exception:
         return []
 
 def _ensure_item_avg_lab(it: dict) -> dict:
     return it
 
+def _ui_item(it: dict, hydrated: Optional[List[str]] = None) -> dict:
+    pid = it.get("id")
+    title = it.get("name") or it.get("title") or pid
+    price = it.get("basePrice") or it.get("price") or 0
+
+    images = hydrated or _normalize_images(it)
+    img = images[0] if images else ""
+    return {
+        **it,
+        "id": pid, "slug": pid,
+        "name": title, "title": title,
+        "imageUrl": img, "image": img, "thumbnail": img, "primaryImage": img,
+        "images": images,
+        "basePrice": price, "price": price,
+    }
+
 def _to_ui(items: List[dict], size_pref: Optional[str] = None, color_pref: Optional[str] = None) -> List[dict]:
     out: List[dict] = []
     for it in items:
         pid = it.get("id")
-        title = it.get("name") or it.get("title") or pid
-        price = it.get("basePrice") or it.get("price") or 0
-
-        images = _normalize_images(it)
-        if pid:
-            fs_imgs = _hydrate_images_from_firestore(pid, color_pref=color_pref, size_pref=size_pref)
-            if fs_imgs:
-                images = fs_imgs
-
-        img = images[0] if images else ""
-        out.append({
-            **it,
-            "id": pid, "slug": pid,
-            "name": title, "title": title,
-            "imageUrl": img, "image": img, "thumbnail": img, "primaryImage": img,
-            "images": images,
-            "basePrice": price, "price": price,
-        })
+        fs_imgs = _hydrate_images_from_firestore(pid, color_pref=color_pref, size_pref=size_pref) if pid else []
+        out.append(_ui_item(it, fs_imgs))
     return out
 
-@app.route("/health", methods=["GET"])
-def plain_health():
-    return jsonify({"status": "ok", "project": PROJECT_ID or "<unset>"}), 200
-
-@app.route("/reco/health", methods=["GET"])
-@app.route("/reco/debug/health", methods=["GET"])
-def debug_health():
-    return jsonify({"status": "ok", "project": PROJECT_ID or "<unset>"}), 200
-
-@app.post("/reco/recommend")   
-@app.post("/recommend")        
-def recommend():
+# -----------------------------------------------------------------------------
+# Recommendation core (shared by the Flask routes and asgi.py)
+# -----------------------------------------------------------------------------
+class UploadTooLarge(Exception):
+    pass
+
+def _read_limited(stream, limit: int = MAX_UPLOAD_BYTES, chunk: int = 64 * 1024) -> bytes:
+    """Read a request/file stream into one buffer, failing past `limit` bytes."""
+    buf = io.BytesIO()
+    while True:
+        part = stream.read(chunk)
+        if not part:
+            break
+        buf.write(part)
+        if buf.tell() > limit:
+            raise UploadTooLarge()
+    return buf.getvalue()
+
+def _decode_image(raw: Optional[bytes]) -> Optional[Image.Image]:
+    """Decode a room photo once; large JPEGs are draft-decoded near MAX_IMAGE_SIDE."""
+    if not raw:
+        return None
     try:
-        data = request.get_json(force=True) or {}
+        im = Image.open(io.BytesIO(raw))
+        im.draft("RGB", (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+        return im.convert("RGB")
     except Exception:
-        return jsonify({"error": "Invalid JSON"}), 400
+        return None
 
-    text            = (data.get("text") or "").strip()
-    img_b64         = data.get("image_b64")
-    k               = int(data.get("k") or 24)
-    f_type          = (data.get("type") or "").strip()
-    size_pref       = (data.get("size") or "").strip()
-    color_pref      = (data.get("color") or "").strip()
-    force_ai        = bool(data.get("force_ai", False))
-    
-    w_image = 1.0 
-    w_text  = 0.0
+def _as_bool(v) -> bool:
+    if isinstance(v, str):
+        return v.strip().lower() in ("1", "true", "yes", "on")
+    return bool(v)
+
+def _parse_reco_params(data: dict, image_bytes: Optional[bytes] = None) -> dict:
+    """
+    Normalize request fields. The room photo comes either as raw bytes
+    (multipart/raw upload) or as the legacy image_b64 field, and is decoded
+    here exactly once for both CLIP and Gemini.
+    """
+    if image_bytes is None and data.get("image_b64"):
+        try:
+            image_bytes = base64.b64decode(data.get("image_b64"))
+        except Exception:
+            image_bytes = None
 
     try:
         min_budget = float(data.get("min_budget")) if data.get("min_budget") else None
@@ -447,12 +577,67 @@ def recommend():
     except ValueError:
         min_budget, max_budget = None, None
 
-    qvec = encoder.embed_query(text=text, image_b64=img_b64, w_image=w_image, w_text=w_text)
-    rows, scores = searcher.search(qvec, k=max(k, 60))
+    return {
+        "text":       (data.get("text") or "").strip(),
+        "image":      _decode_image(image_bytes),
+        "k":          int(data.get("k") or 24),
+        "f_type":     (data.get("type") or "").strip(),
+        "size_pref":  (data.get("size") or "").strip(),
+        "color_pref": (data.get("color") or "").strip(),
+        "force_ai":   _as_bool(data.get("force_ai", False)),
+        "w_image":    1.0,
+        "w_text":     0.0,
+        "min_budget": min_budget,
+        "max_budget": max_budget,
+        "shape":      (data.get("shape") or "full").strip().lower(),
+        "fields":     _parse_fields(data.get("fields")),
+    }
+
+def _parse_fields(v) -> Optional[List[str]]:
+    if isinstance(v, str):
+        v = v.split(",")
+    if not isinstance(v, list):
+        return None
+    out = [str(f).strip() for f in v if str(f).strip()]
+    return out or None
+
+def _search_depth(p: dict) -> int:
+    return max(p["k"], 60)
+
+def _embed_and_search(p: dict):
+    qvec = encoder.embed_query(text=p["text"], image=p["image"], w_image=p["w_image"], w_text=p["w_text"])
+    rows, scores = searcher.search(qvec, k=_search_depth(p), partitions=list(_partitions_for_type(p["f_type"])))
+    return qvec, rows, scores
+
+def _rank_candidates(p: dict) -> Tuple[List[dict], dict]:
+    """
+    Embed + search inside the inference pool, then apply the request filters.
+
+    Returns the top k items plus the ranking state (query vector, filtered
+    (row, score) list, search depth) that _open_cursor can keep for paging.
+    """
+    qvec, rows, scores = pool.run(_embed_and_search, p)
+    depth = _search_depth(p)
+    ranked = _filter_rows(p, rows, scores)
+    state = {
+        "qvec": qvec, "ranked": ranked, "depth": depth,
+        "exhausted": len(rows) < depth or depth >= art.size(),
+    }
+    return _items_for(ranked[:p["k"]]), state
+
+def _items_for(ranked: List[Tuple[int, float]]) -> List[dict]:
+    # rows removed online since a cursor was opened are empty dicts
+    items = [(art.row_to_item(row), sc) for row, sc in ranked]
+    return [{**it, "score": sc} for it, sc in items if it]
 
-    ranked: List[dict] = []
+def _filter_rows(p: dict, rows: List[int], scores: List[float]) -> List[Tuple[int, float]]:
+    """Apply type/budget/color/size filters; returns (row, score) best first."""
+    f_type, size_pref, color_pref = p["f_type"], p["size_pref"], p["color_pref"]
+    min_budget, max_budget = p["min_budget"], p["max_budget"]
+
+    ranked: List[Tuple[int, float]] = []
     for row, sc in zip(rows, scores):
-        it = dict(art.row_to_item(row))
+        it = art.row_to_item(row)
         pid = it.get("id")
         if not pid: continue
         if f_type and not _type_matches(it, f_type): continue
@@ -467,39 +652,345 @@ def recommend():
         if size_pref and size_pref.lower() != "none":
             if _size_match_score(it, size_pref) == 0.0: continue
 
-        it["score"] = float(sc)
-        ranked.append(it)
+        ranked.append((row, float(sc)))
+
+    ranked.sort(key=lambda x: x[1], reverse=True)
+    return ranked
+
+class CursorExpired(Exception):
+    pass
+
+class _CursorCache:
+    """
+    TTL + LRU store for paginated /recommend.
+
+    Each entry keeps the filtered (row, score) list, the query vector and
+    the request filters, so "load more" skips decoding, CLIP and FAISS.
+    Entries are evicted least-recently-used once CURSOR_MAX_ENTRIES or the
+    approximate CURSOR_MAX_BYTES budget is exceeded.
+    """
+
+    _ROW_BYTES = 100  # (row, score) tuple + int + float objects
+
+    def __init__(self, ttl_s: int, max_entries: int, max_bytes: int):
+        self.ttl_s, self.max_entries, self.max_bytes = ttl_s, max_entries, max_bytes
+        self._d: "OrderedDict[str, dict]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _size(self, entry: dict) -> int:
+        return len(entry["ranked"]) * self._ROW_BYTES + int(entry["qvec"].numel()) * 4 + 512
+
+    def _drop(self, token: str):
+        old = self._d.pop(token, None)
+        if old is not None:
+            self._bytes -= old["_bytes"]
+
+    def put(self, entry: dict, token: Optional[str] = None) -> str:
+        token = token or secrets.token_urlsafe(12)
+        entry = {**entry, "_bytes": self._size(entry), "_expires": time.time() + self.ttl_s}
+        with self._lock:
+            self._drop(token)
+            self._d[token] = entry
+            self._bytes += entry["_bytes"]
+            while self._d and (len(self._d) > self.max_entries or self._bytes > self.max_bytes):
+                self._drop(next(iter(self._d)))
+        return token
+
+    def get(self, token: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._d.get(token)
+            if entry is None:
+                return None
+            if entry["_expires"] < time.time():
+                self._drop(token)
+                return None
+            self._d.move_to_end(token)
+            return entry
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._d), "approx_bytes": self._bytes}
+
+cursors = _CursorCache(CURSOR_TTL_S, CURSOR_MAX_ENTRIES, CURSOR_MAX_BYTES)
+
+def _open_cursor(p: dict, state: dict) -> Optional[str]:
+    """Cursor for the page after the first p["k"] items, or None if there is none."""
+    if len(state["ranked"]) <= p["k"] and state["exhausted"]:
+        return None
+    filters = {k: v for k, v in p.items() if k != "image"}
+    token = cursors.put({**state, "p": filters, "offsets": frozenset([p["k"]])})
+    return f"{token}.{p['k']}"
+
+def _next_page(cursor: str, k: int) -> Tuple[List[dict], Optional[str], dict]:
+    """
+    Serve items [offset, offset + k) of a cursor's ranked list. If the list
+    runs short, FAISS is searched deeper with the cached query vector and
+    the cached filters are re-applied; CLIP is never re-run. Only offsets
+    this server issued for the entry are accepted, so a client cannot pick
+    an arbitrary depth to search.
+    """
+    token, _, off = (cursor or "").rpartition(".")
+    entry = cursors.get(token) if off.isdigit() else None
+    if entry is None or int(off) not in entry["offsets"] or int(off) > len(entry["ranked"]):
+        raise CursorExpired()
+
+    offset = int(off)
+    need = offset + k
+    if len(entry["ranked"]) < need and not entry["exhausted"]:
+        depth = min(max(2 * entry["depth"], 2 * need), art.size())
+        parts = list(_partitions_for_type(entry["p"]["f_type"]))
+        rows, scores = pool.run(searcher.search, entry["qvec"], depth, parts)
+        entry = {
+            **entry, "ranked": _filter_rows(entry["p"], rows, scores), "depth": depth,
+            "exhausted": len(rows) < depth or depth >= art.size(),
+        }
+        cursors.put(entry, token=token)
+
+    page = entry["ranked"][offset:need]
+    more = len(entry["ranked"]) > need or not entry["exhausted"]
+    if not (page and more):
+        return _items_for(page), None, entry["p"]
+    if need not in entry["offsets"]:
+        cursors.put({**entry, "offsets": entry["offsets"] | {need}}, token=token)
+    return _items_for(page), f"{token}.{need}", entry["p"]
+
+def _needs_ai_fallback(p: dict, top_matches: List[dict]) -> bool:
+    if p["force_ai"]:
+        return True
+    if p["image"] is not None and len(top_matches) > 0:
+        return top_matches[0]["score"] < SUITABILITY_THRESHOLD
+    return False
+
+def _gemini_kwargs(p: dict) -> dict:
+    return dict(
+        img_b64=None, text=p["text"], f_type=p["f_type"], size_pref=p["size_pref"],
+        color_pref=p["color_pref"], min_b=p["min_budget"], max_b=p["max_budget"], image=p["image"],
+    )
+
+def _project(items: List[dict], fields: List[str]) -> List[dict]:
+    keep = ["id"] + [f for f in fields if f != "id"]
+    return [{f: it[f] for f in keep if f in it} for it in items]
+
+def _reco_payload(payload_items: List[dict], ai_designer_data: Optional[dict], p: Optional[dict] = None,
+                  cursor: Optional[str] = None) -> dict:
+    """
+    Response body. The default "full" shape keeps the legacy triple list for
+    old clients; shape="compact" returns one projected list (COMPACT_FIELDS
+    unless the caller passes "fields"). "fields" alone projects the full shape.
+    "cursor" is passed back as {"cursor": ...} to fetch the next page.
+    """
+    p = p or {}
+    compact = p.get("shape") == "compact"
+    fields = p.get("fields") or (COMPACT_FIELDS if compact else None)
+    if fields:
+        payload_items = _project(payload_items, fields)
+
+    if compact:
+        return {
+            "items": payload_items,
+            "ai_designer": ai_designer_data,
+            "from": "catalog" if len(payload_items) > 0 else "ai_fallback",
+            "count": len(payload_items),
+            "cursor": cursor,
+        }
+    return {
+        "items": payload_items,
+        "products": payload_items,
+        "results": payload_items,
+        "ai_designer": ai_designer_data,
+        "from": "catalog" if len(payload_items) > 0 else "ai_fallback",
+        "count": len(payload_items),
+        "fallback": None,
+        "cursor": cursor,
+    }
+
+def _json_bytes(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _encode_response(obj, accept_encoding: str) -> Tuple[bytes, dict]:
+    """
+    Serialize and, above COMPRESS_MIN_BYTES, compress (br if available, else
+    gzip). X-Payload-Bytes / X-Serialize-Ms report the uncompressed size and
+    encode time so shapes and encoders can be compared from the client side.
+    """
+    t0 = time.perf_counter()
+    raw = _json_bytes(obj)
+    headers = {
+        "Content-Type": "application/json",
+        "Vary": "Accept-Encoding",
+        "X-Payload-Bytes": str(len(raw)),
+    }
+    body = raw
+    if len(raw) >= COMPRESS_MIN_BYTES:
+        ae = (accept_encoding or "").lower()
+        if brotli is not None and "br" in ae:
+            body = brotli.compress(raw, quality=4)
+            headers["Content-Encoding"] = "br"
+        elif "gzip" in ae:
+            body = gzip.compress(raw, compresslevel=5)
+            headers["Content-Encoding"] = "gzip"
+    headers["X-Serialize-Ms"] = f"{1000 * (time.perf_counter() - t0):.2f}"
+    return body, headers
+
+def _overloaded_body(e: PoolOverloaded) -> Tuple[dict, dict]:
+    return {"error": "Recommender is busy, please retry", "reason": e.reason}, {"Retry-After": str(e.retry_after)}
+
+def _apply_product(pid: str, data: Optional[dict]) -> dict:
+    """Index an active Firestore product, drop a deleted or inactive one."""
+    if data is None or data.get("active") is not True:
+        return online.remove(pid)
+    return online.upsert({**data, "id": pid})
+
+def _admin_products(auth: str, data: dict) -> Tuple[dict, int, dict]:
+    """
+    POST /reco/admin/products: {"id": ..., "op": "upsert" | "remove", "product": {...}?}
+    Without "product" an upsert re-reads the Firestore document. Returns
+    (body, status, headers) for both the Flask and ASGI routes.
+    """
+    if not RECO_ADMIN_TOKEN:
+        return {"error": "Not found"}, 404, {}
+    if not secrets.compare_digest(auth.encode("utf-8"), f"Bearer {RECO_ADMIN_TOKEN}".encode("utf-8")):
+        return {"error": "Unauthorized"}, 401, {}
+    if online is None:
+        return {"error": "Online updates need ONLINE_UPDATES=1 and INDEX_MODE=flat"}, 409, {}
+
+    pid = str(data.get("id") or "").strip()
+    op = data.get("op") or "upsert"
+    if not pid or op not in ("upsert", "remove"):
+        return {"error": "Expected an id and op upsert|remove"}, 400, {}
+    try:
+        if op == "remove":
+            return online.remove(pid), 200, {}
+        product = data.get("product")
+        if not isinstance(product, dict):
+            snap = db.collection("products").document(pid).get()
+            product = snap.to_dict() if snap.exists else None
+        # same rules as the change feed: inactive products are removed
+        return _apply_product(pid, product), 200, {}
+    except PoolOverloaded as e:
+        body, headers = _overloaded_body(e)
+        return body, 503, headers
+    except (TypeError, ValueError) as e:
+        return {"error": f"Product cannot be indexed: {e}"}, 400, {}
+
+# Firestore change feed -> online index, off the listener thread
+_feed_q: "queue.Queue[Tuple[str, Optional[dict]]]" = queue.Queue()
+
+def _feed_worker():
+    while True:
+        pid, data = _feed_q.get()
+        try:
+            _apply_product(pid, data)
+        except PoolOverloaded as e:
+            time.sleep(e.retry_after)
+            _feed_q.put((pid, data))
+        except Exception as e:
+            print(f"Online feed update failed for {pid}: {e}")
+
+if ONLINE_FEED and online is not None and mirror is not None:
+    mirror.add_listener(lambda pid, data: _feed_q.put((pid, data)))
+    threading.Thread(target=_feed_worker, name="online-feed", daemon=True).start()
 
-    ranked.sort(key=lambda x: x["score"], reverse=True)
-    top_matches = ranked[:k]
-    
-    force_ai_fallback = force_ai
+@app.route("/health", methods=["GET"])
+def plain_health():
+    return jsonify({"status": "ok", "project": PROJECT_ID or "<unset>"}), 200
 
-    if img_b64 and len(top_matches) > 0:
-        best_score = top_matches[0]["score"]
-        if best_score < SUITABILITY_THRESHOLD:
-            force_ai_fallback = True
+@app.route("/reco/health", methods=["GET"])
+@app.route("/reco/debug/health", methods=["GET"])
+def debug_health():
+    return jsonify({
+        "status": "ok", "project": PROJECT_ID or "<unset>",
+        "inference": pool.stats(), "index": art.memory_bytes(), "cursors": cursors.stats(),
+        "mirror": mirror.stats() if mirror is not None else None,
+        "online": online.stats() if online is not None else None,
+        "concepts": concept_store.stats() if concept_store is not None else None,
+    }), 200
+
+@app.get(f"{CONCEPT_PATH}/<name>")
+def concept_image(name: str):
+    body, status, headers = _concept_response(name, request.headers.get("If-None-Match", ""))
+    return Response(body, status=status, headers=headers)
+
+@app.post("/reco/admin/products")
+def admin_products():
+    body, status, headers = _admin_products(request.headers.get("Authorization", ""), request.get_json(silent=True) or {})
+    return jsonify(body), status, headers
 
-    if force_ai_fallback:
+@app.post("/reco/recommend")   
+@app.post("/recommend")        
+def recommend():
+    """
+    Accepts application/json (optionally with image_b64), multipart/form-data
+    (fields as form fields, photo in the "image" part) or a raw image/* body
+    with fields in the query string.
+    """
+    ctype = (request.mimetype or "").lower()
+    image_bytes = None
+    try:
+        if ctype == "multipart/form-data":
+            data = request.form.to_dict()
+            f = request.files.get("image")
+            if f:
+                image_bytes = _read_limited(f.stream)
+        elif ctype.startswith("image/") or ctype == "application/octet-stream":
+            data = request.args.to_dict()
+            image_bytes = _read_limited(request.stream)
+        else:
+            data = request.get_json(force=True) or {}
+    except (UploadTooLarge, RequestEntityTooLarge):
+        # MAX_CONTENT_LENGTH trips inside get_json()/request.form for JSON and multipart bodies
+        return jsonify({"error": f"Image larger than {MAX_UPLOAD_BYTES} bytes"}), 413
+    except Exception:
+        return jsonify({"error": "Invalid JSON"}), 400
+
+    if data.get("cursor"):
+        return _recommend_page(data)
+
+    p = _parse_reco_params(data, image_bytes)
+
+    try:
+        top_matches, state = _rank_candidates(p)
+    except PoolOverloaded as e:
+        body, headers = _overloaded_body(e)
+        return jsonify(body), 503, headers
+
+    cursor = None
+    if _needs_ai_fallback(p, top_matches):
         payload_items = []
     else:
-        payload_items = _to_ui(top_matches, size_pref=size_pref, color_pref=color_pref)
+        payload_items = _to_ui(top_matches, size_pref=p["size_pref"], color_pref=p["color_pref"])
+        cursor = _open_cursor(p, state)
 
     ai_designer_data = None
     if len(payload_items) == 0 and GEMINI_API_KEY:
-        ai_designer_data = analyze_with_gemini(
-            img_b64=img_b64, text=text, f_type=f_type, size_pref=size_pref, color_pref=color_pref, min_b=min_budget, max_b=max_budget
+        ai_designer_data = _absolute_concept_urls(
+            analyze_with_gemini(**_gemini_kwargs(p)), _public_base(request.scheme, request.host, request.headers)
         )
 
-    return jsonify({
-        "items": payload_items,
-        "products": payload_items,
-        "results": payload_items,
-        "ai_designer": ai_designer_data,
-        "from": "catalog" if len(payload_items) > 0 else "ai_fallback",
-        "count": len(payload_items),
-        "fallback": None,
-    })
+    body, headers = _encode_response(
+        _reco_payload(payload_items, ai_designer_data, p, cursor=cursor), request.headers.get("Accept-Encoding", "")
+    )
+    return Response(body, status=200, headers=headers)
+
+def _recommend_page(data: dict):
+    """Follow-up page: hydrate only the next slice of a cached ranking."""
+    p = _parse_reco_params(data)
+    try:
+        items, cursor, filters = _next_page(str(data.get("cursor")), p["k"])
+    except CursorExpired:
+        return jsonify({"error": "Cursor expired, repeat the search"}), 410
+    except PoolOverloaded as e:
+        body, headers = _overloaded_body(e)
+        return jsonify(body), 503, headers
+
+    payload_items = _to_ui(items, size_pref=filters["size_pref"], color_pref=filters["color_pref"])
+    body, headers = _encode_response(
+        _reco_payload(payload_items, None, p, cursor=cursor), request.headers.get("Accept-Encoding", "")
+    )
+    return Response(body, status=200, headers=headers)
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=PORT, debug=True)
\ No newline at end of file
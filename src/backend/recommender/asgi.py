@@ -0,0 +1,275 @@
+# asgi.py
+"""
+ASGI entry point for the recommender.
+
+Shares the recommendation core with app.py (same artifacts, encoder, pool,
+filters and payload shape) but keeps the per-request network waits off
+worker threads:
+  - CLIP + FAISS run in their own thread executor sized to the inference
+    pool, and are refused up front once it is full
+  - Firestore hydration uses the async client, all items concurrently;
+    mirror lookups and URL signing run once per page on an I/O executor
+  - Gemini / OpenRouter calls use async clients, concepts concurrently
+
+Run with:
+  uvicorn asgi:app --host 0.0.0.0 --port 8080 --workers 1
+"""
+import asyncio, os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import httpx
+from google.cloud import firestore
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+import app as core
+from model import PoolOverloaded
+
+ASGI_IO_THREADS = int(os.getenv("ASGI_IO_THREADS", "16"))
+
+# Enough threads for every slot plus every queued waiter, so the pool's own
+# admission control decides who waits and who is rejected. Only ranking runs
+# here, and nothing is submitted beyond the thread count: a job queued inside
+# the executor would wait outside the pool's max_queue and deadline.
+_INFER_THREADS = core.INFERENCE_SLOTS + core.INFERENCE_MAX_QUEUE
+_infer_executor = ThreadPoolExecutor(max_workers=_INFER_THREADS, thread_name_prefix="infer")
+_infer_submitted = 0   # touched only on the event loop
+
+# Everything else that blocks: image decoding, hydration pages, URL signing,
+# the concept store and admin calls.
+_io_executor = ThreadPoolExecutor(max_workers=ASGI_IO_THREADS, thread_name_prefix="io")
+
+adb = firestore.AsyncClient(project=core.PROJECT_ID or None)
+http: Optional[httpx.AsyncClient] = None
+
+
+# -----------------------------------------------------------------------------
+# Async I/O helpers
+# -----------------------------------------------------------------------------
+async def _run_blocking(fn, *args):
+    return await asyncio.get_running_loop().run_in_executor(_io_executor, fn, *args)
+
+async def _run_inference(fn, *args):
+    """Run a ranking call on the inference executor; PoolOverloaded when every thread is taken."""
+    global _infer_submitted
+    if _infer_submitted >= _INFER_THREADS:
+        raise core.pool.reject_queue_full()
+    loop = asyncio.get_running_loop()
+
+    def _release(_):
+        global _infer_submitted
+        _infer_submitted -= 1
+
+    _infer_submitted += 1
+    # released when the thread finishes, not when a cancelled request stops waiting
+    fut = _infer_executor.submit(fn, *args)
+    fut.add_done_callback(lambda f: loop.call_soon_threadsafe(_release, f))
+    return await asyncio.wrap_future(fut)
+
+async def _fetch_product(pid: str) -> Optional[dict]:
+    try:
+        snap = await adb.collection("products").document(pid).get()
+    except Exception:
+        return None
+    return (snap.to_dict() or {}) if snap.exists else None
+
+def _ui_page(items: List[dict], docs: List[Optional[dict]], size_pref: Optional[str], color_pref: Optional[str]) -> List[dict]:
+    # URL signing may call IAM, so this runs on the I/O executor
+    return [
+        core._ui_item(it, core._images_from_product_doc(d, color_pref, size_pref) if d is not None else [])
+        for it, d in zip(items, docs)
+    ]
+
+async def _to_ui_async(items: List[dict], size_pref: Optional[str] = None, color_pref: Optional[str] = None) -> List[dict]:
+    if core.mirror is not None and core.mirror.ready:
+        # mirror lookups + signing for the whole page in one executor hop
+        return await _run_blocking(core._to_ui, items, size_pref, color_pref)
+    docs = await asyncio.gather(*[
+        _fetch_product(it["id"]) if it.get("id") else asyncio.sleep(0, result=None)
+        for it in items
+    ])
+    return await _run_blocking(_ui_page, items, docs, size_pref, color_pref)
+
+async def _generate_concept_image_async(img_prompt: str) -> str:
+    if not core.OPENROUTER_API_KEY:
+        return core._PLACEHOLDER_NO_KEY
+    cached = await _run_blocking(core._cached_concept_image, img_prompt)
+    if cached:
+        return cached
+    try:
+        headers, body = core._router_request(img_prompt)
+        router_res = await http.post(core.OPENROUTER_URL, headers=headers, json=body, timeout=45)
+        router_res.raise_for_status()
+        # base64 decode + WebP transcode is CPU work, keep it off the event loop
+        return await _run_blocking(core._store_concept_image, img_prompt, core._router_image_url(router_res.json()))
+    except Exception as e:
+        print(f"OpenRouter Error: {e}")
+        return core._PLACEHOLDER_FAILED
+
+async def analyze_with_gemini_async(img_b64, text, f_type, size_pref, color_pref, min_b, max_b, image=None):
+    try:
+        if not core.gemini_client:
+            return {"room_analysis": "🚨 DEBUG: No Gemini API Key found!", "custom_concepts": []}
+
+        response = await core.gemini_client.aio.models.generate_content(
+            model=core.GEMINI_MODEL,
+            contents=core._gemini_contents(img_b64, f_type, size_pref, color_pref, image=image)
+        )
+        parsed = core._parse_gemini_json(response.text)
+
+        concepts = parsed.get("custom_concepts", [])
+        urls = await asyncio.gather(*[
+            _generate_concept_image_async(core._concept_image_prompt(c, f_type, color_pref))
+            for c in concepts
+        ])
+        for concept, url in zip(concepts, urls):
+            core._set_concept_image(concept, url)
+
+        return parsed
+    except Exception as e:
+        print(f"Gemini Process Error: {e}")
+        return {"room_analysis": f"🚨 DEBUG ERROR: {str(e)}", "custom_concepts": []}
+
+
+# -----------------------------------------------------------------------------
+# Routes
+# -----------------------------------------------------------------------------
+async def plain_health(request: Request):
+    return JSONResponse({"status": "ok", "project": core.PROJECT_ID or "<unset>"})
+
+async def debug_health(request: Request):
+    return JSONResponse({
+        "status": "ok", "project": core.PROJECT_ID or "<unset>",
+        # memory_bytes takes the index read lock, which waits out online updates
+        "inference": core.pool.stats(), "index": await _run_blocking(core.art.memory_bytes), "cursors": core.cursors.stats(),
+        "mirror": core.mirror.stats() if core.mirror is not None else None,
+        "online": core.online.stats() if core.online is not None else None,
+        "concepts": core.concept_store.stats() if core.concept_store is not None else None,
+    })
+
+async def concept_image(request: Request):
+    body, status, headers = await _run_blocking(
+        core._concept_response, request.path_params["name"], request.headers.get("if-none-match", "")
+    )
+    return Response(body, status_code=status, headers=headers)
+
+async def admin_products(request: Request):
+    try:
+        data = await request.json() or {}
+    except Exception:
+        data = {}
+    # embedding and Firestore reads are blocking
+    body, status, headers = await _run_blocking(core._admin_products, request.headers.get("authorization", ""), data)
+    return JSONResponse(body, status_code=status, headers=headers)
+
+async def _read_body_limited(request: Request) -> bytes:
+    buf = bytearray()
+    async for chunk in request.stream():
+        buf.extend(chunk)
+        if len(buf) > core.MAX_UPLOAD_BYTES:
+            raise core.UploadTooLarge()
+    return bytes(buf)
+
+async def _read_reco_request(request: Request):
+    """Same inputs as the Flask route: JSON, multipart/form-data or raw image/*."""
+    ctype = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if int(request.headers.get("content-length") or 0) > core.app.config["MAX_CONTENT_LENGTH"]:
+        raise core.UploadTooLarge()
+    if ctype == "multipart/form-data":
+        form = await request.form()
+        data = {k: v for k, v in form.items() if isinstance(v, str)}
+        image_bytes = None
+        upload = form.get("image")
+        if upload is not None and not isinstance(upload, str):
+            image_bytes = await upload.read(core.MAX_UPLOAD_BYTES + 1)
+            if len(image_bytes) > core.MAX_UPLOAD_BYTES:
+                raise core.UploadTooLarge()
+        return data, image_bytes
+    if ctype.startswith("image/") or ctype == "application/octet-stream":
+        return dict(request.query_params), await _read_body_limited(request)
+    return (await request.json() or {}), None
+
+async def recommend(request: Request):
+    try:
+        data, image_bytes = await _read_reco_request(request)
+    except core.UploadTooLarge:
+        return JSONResponse({"error": f"Image larger than {core.MAX_UPLOAD_BYTES} bytes"}, status_code=413)
+    except Exception:
+        return JSONResponse({"error": "Invalid JSON"}, status_code=400)
+
+    if data.get("cursor"):
+        return await _recommend_page(request, data)
+
+    # Image decoding is CPU work, keep it off the event loop
+    p = await _run_blocking(core._parse_reco_params, data, image_bytes)
+
+    try:
+        top_matches, state = await _run_inference(core._rank_candidates, p)
+    except PoolOverloaded as e:
+        body, headers = core._overloaded_body(e)
+        return JSONResponse(body, status_code=503, headers=headers)
+
+    cursor = None
+    if core._needs_ai_fallback(p, top_matches):
+        payload_items = []
+    else:
+        payload_items = await _to_ui_async(top_matches, size_pref=p["size_pref"], color_pref=p["color_pref"])
+        cursor = core._open_cursor(p, state)
+
+    ai_designer_data = None
+    if len(payload_items) == 0 and core.GEMINI_API_KEY:
+        ai_designer_data = core._absolute_concept_urls(
+            await analyze_with_gemini_async(**core._gemini_kwargs(p)),
+            core._public_base(request.url.scheme, request.url.netloc, request.headers),
+        )
+
+    body, headers = core._encode_response(
+        core._reco_payload(payload_items, ai_designer_data, p, cursor=cursor), request.headers.get("accept-encoding", "")
+    )
+    return Response(body, status_code=200, headers=headers)
+
+async def _recommend_page(request: Request, data: dict):
+    p = core._parse_reco_params(data)
+    try:
+        items, cursor, filters = await _run_inference(core._next_page, str(data.get("cursor")), p["k"])
+    except core.CursorExpired:
+        return JSONResponse({"error": "Cursor expired, repeat the search"}, status_code=410)
+    except PoolOverloaded as e:
+        body, headers = core._overloaded_body(e)
+        return JSONResponse(body, status_code=503, headers=headers)
+
+    payload_items = await _to_ui_async(items, size_pref=filters["size_pref"], color_pref=filters["color_pref"])
+    body, headers = core._encode_response(
+        core._reco_payload(payload_items, None, p, cursor=cursor), request.headers.get("accept-encoding", "")
+    )
+    return Response(body, status_code=200, headers=headers)
+
+async def _startup():
+    global http
+    http = httpx.AsyncClient(limits=httpx.Limits(max_connections=64, max_keepalive_connections=16))
+
+async def _shutdown():
+    await http.aclose()
+    _infer_executor.shutdown(wait=False)
+    _io_executor.shutdown(wait=False)
+
+
+app = Starlette(
+    routes=[
+        Route("/health", plain_health, methods=["GET"]),
+        Route("/reco/health", debug_health, methods=["GET"]),
+        Route("/reco/debug/health", debug_health, methods=["GET"]),
+        Route("/recommend", recommend, methods=["POST"]),
+        Route("/reco/recommend", recommend, methods=["POST"]),
+        Route("/reco/admin/products", admin_products, methods=["POST"]),
+        Route(core.CONCEPT_PATH + "/{name}", concept_image, methods=["GET"]),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=[core.CORS_ALLOWED_ORIGIN], allow_methods=["*"], allow_headers=["*"], expose_headers=core.EXPOSE_HEADERS)],
+    on_startup=[_startup],
+    on_shutdown=[_shutdown],
+)
@@ -0,0 +1,319 @@
+# bench.py
+"""
+Microbenchmarks for the recommender components at synthetic scale.
+
+Measures:
+  - ClipQueryEncoder text / image throughput across batch sizes and threads
+  - FaissSearcher.search latency vs catalog size (global, category partition,
+    scalar-quantized + exact rerank)
+  - ArtifactIndex.load time and memory for generated mapping.json files
+  - filters.py helpers (type / size / color matching) per catalog row
+
+Everything runs offline: --model random builds a small random-weight CLIP so
+no checkpoint download is needed. Results are written as JSON; pass
+--baseline with an earlier file to print per-benchmark ratios.
+
+  python bench.py --quick --model random --out bench.json
+  python bench.py --out bench-new.json --baseline bench-old.json
+"""
+import argparse, json, os, platform, resource, subprocess, tempfile, time, tracemalloc
+
+import faiss
+import numpy as np
+import torch
+import clip
+from PIL import Image
+
+from catalog import idmap_index
+from filters import _type_matches, _size_match_score, _color_match_score
+from model import ArtifactIndex, ClipQueryEncoder, FaissSearcher
+
+SLUGS = ["beds", "sofas", "tables", "living-chairs", "sectionals", "ottomans"]
+DEPARTMENTS = ["bedroom", "living-room", "dining-room", "outdoor"]
+COLORS = ["Red", "White", "Black", "Brown", "Beige", "Gray"]
+SIZES = ["Single", "Double", "Queen", "King", "2-Seater", "3-Seater", "4 People", "6 People"]
+
+
+# ---------------------------------------------------------------------------
+# Helpers
+# ---------------------------------------------------------------------------
+def _timeit(fn, repeat: int, warmup: int = 1) -> dict:
+    for _ in range(warmup):
+        fn()
+    ts = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        ts.append(time.perf_counter() - t0)
+    ts = np.asarray(ts) * 1000.0
+    return {
+        "mean_ms": round(float(ts.mean()), 4),
+        "p50_ms": round(float(np.percentile(ts, 50)), 4),
+        "p95_ms": round(float(np.percentile(ts, 95)), 4),
+    }
+
+
+def _git_commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True).strip()
+    except Exception:
+        return ""
+
+
+def _unit_vectors(n: int, d: int, rng) -> np.ndarray:
+    X = rng.standard_normal((n, d), dtype=np.float32)
+    X /= np.linalg.norm(X, axis=1, keepdims=True)
+    return X
+
+
+def _synthetic_mapping(n: int, rng) -> list:
+    rows = []
+    for i in range(n):
+        slug = SLUGS[i % len(SLUGS)]
+        colors = [{"name": c} for c in rng.choice(COLORS, size=3, replace=False)]
+        sizes = [{"id": s.lower(), "label": s} for s in rng.choice(SIZES, size=3, replace=False)]
+        img = f"gs://bench-bucket/products/{slug}/{i}.jpg"
+        rows.append({
+            "id": f"{slug}-{i}",
+            "title": f"Synthetic {slug} {i}",
+            "baseType": slug.split("-")[-1].capitalize(),
+            "departmentSlug": [DEPARTMENTS[i % len(DEPARTMENTS)], DEPARTMENTS[(i + 1) % len(DEPARTMENTS)]],
+            "categorySlug": slug,
+            "materials": [],
+            "seatCount": int(i % 6) + 1,
+            "colorOptions": colors,
+            "sizeOptions": sizes,
+            "basePrice": int(rng.integers(1000, 60000)),
+            "image": img,
+            "thumbnail": img,
+            "defaultImagePath": img,
+            "heroImage": "",
+            "images": [img],
+            "imagesByOption": {c["name"]: {s["label"]: [img] for s in sizes} for c in colors},
+            "avg_lab": [float(x) for x in rng.uniform(0, 255, 3)],
+        })
+    return rows
+
+
+def _tiny_clip():
+    """Random-weight CLIP with the real tokenizer/preprocess, for offline runs."""
+    model = clip.model.CLIP(
+        embed_dim=128, image_resolution=224, vision_layers=2, vision_width=128,
+        vision_patch_size=32, context_length=77, vocab_size=49408,
+        transformer_width=128, transformer_heads=2, transformer_layers=2,
+    ).float()
+    return model, clip.clip._transform(224)
+
+
+def _make_encoder(model_name: str) -> ClipQueryEncoder:
+    if model_name == "random":
+        model, preprocess = _tiny_clip()
+        return ClipQueryEncoder(model=model, preprocess=preprocess)
+    return ClipQueryEncoder(model_name)
+
+
+# ---------------------------------------------------------------------------
+# Benchmarks
+# ---------------------------------------------------------------------------
+def bench_encoder(enc: ClipQueryEncoder, batch_sizes, thread_counts, repeat: int) -> list:
+    rng = np.random.default_rng(0)
+    photos = [
+        Image.fromarray(rng.integers(0, 255, (480, 640, 3), dtype=np.uint8), "RGB")
+        for _ in range(max(batch_sizes))
+    ]
+    out = []
+    for threads in thread_counts:
+        torch.set_num_threads(threads)
+        for bs in batch_sizes:
+            texts = [f"sofa {i}, 3-Seater, red" for i in range(bs)]
+            for kind, fn in (
+                ("text", lambda: enc._encode_texts(texts)),
+                ("image", lambda: enc._encode_images(photos[:bs])),
+            ):
+                r = _timeit(fn, repeat)
+                out.append({
+                    "name": f"encoder.{kind}.t{threads}.b{bs}",
+                    "kind": kind, "threads": threads, "batch": bs, **r,
+                    "items_per_s": round(bs / (r["mean_ms"] / 1000.0), 2),
+                })
+                print(out[-1])
+    return out
+
+
+def bench_search(sizes, dim: int, k: int, repeat: int, rerank_factor: int) -> list:
+    rng = np.random.default_rng(1)
+    Q = [torch.from_numpy(q[None, :]) for q in _unit_vectors(16, dim, rng)]
+    out = []
+    for n in sizes:
+        X = _unit_vectors(n, dim, rng)
+        art = ArtifactIndex(tempfile.gettempdir(), mode="flat")
+        art.index = faiss.IndexFlatIP(dim)
+        art.index.add(X)
+
+        slug_of = np.arange(n) % len(SLUGS)
+        for j, slug in enumerate(SLUGS):
+            rows = np.nonzero(slug_of == j)[0]
+            art.partitions[slug] = idmap_index(X[rows], rows)
+            art.partition_rows[slug] = rows.astype(np.int64)
+
+        searcher = FaissSearcher(art, rerank_factor=rerank_factor)
+        qi = iter(range(1 << 30))
+
+        def _q():
+            return Q[next(qi) % len(Q)]
+
+        for name, fn in (
+            ("global", lambda: searcher.search(_q(), k)),
+            ("partition", lambda: searcher.search(_q(), k, partitions=["beds"])),
+        ):
+            out.append({"name": f"search.{name}.n{n}", "n": n, "dim": dim, "k": k, **_timeit(fn, repeat)})
+            print(out[-1])
+
+        for qt_name, qt in (("fp16", faiss.ScalarQuantizer.QT_fp16), ("int8", faiss.ScalarQuantizer.QT_8bit)):
+            sq = faiss.IndexScalarQuantizer(dim, qt, faiss.METRIC_INNER_PRODUCT)
+            sq.train(X)
+            sq.add(X)
+            art_sq = ArtifactIndex(tempfile.gettempdir(), mode="sq")
+            art_sq.index, art_sq.exact = sq, X
+            s_sq = FaissSearcher(art_sq, rerank_factor=rerank_factor)
+
+            agree = 0.0
+            for q in Q:
+                truth = set(searcher.search(q, k)[0])
+                agree += len(truth & set(s_sq.search(q, k)[0])) / k
+            out.append({
+                "name": f"search.sq_{qt_name}_rerank.n{n}", "n": n, "dim": dim, "k": k,
+                **_timeit(lambda: s_sq.search(_q(), k), repeat),
+                "index_bytes": int(faiss.serialize_index(sq).nbytes),
+                "flat_bytes": int(n * dim * 4),
+                "topk_agreement": round(agree / len(Q), 4),
+            })
+            print(out[-1])
+            del sq, art_sq, s_sq
+        del art, searcher, X
+    return out
+
+
+def bench_load(sizes, dim: int) -> list:
+    rng = np.random.default_rng(2)
+    out = []
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            index = idmap_index(_unit_vectors(n, dim, rng), np.arange(n))
+            faiss.write_index(index, os.path.join(tmp, "products.faiss"))
+            del index
+            with open(os.path.join(tmp, "mapping.json"), "w", encoding="utf-8") as f:
+                json.dump(_synthetic_mapping(n, rng), f)
+
+            # timed load without tracemalloc (its hooks slow the mapping parse ~3x)
+            art = ArtifactIndex(tmp, mode="flat")
+            rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            t0 = time.perf_counter()
+            art.load()
+            dt = time.perf_counter() - t0
+            rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            del art
+
+            # separate load for the Python allocation peak
+            art = ArtifactIndex(tmp, mode="flat")
+            tracemalloc.start()
+            art.load()
+            _, py_peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            out.append({
+                "name": f"load.n{n}", "n": n, "dim": dim,
+                "mean_ms": round(dt * 1000.0, 2),
+                "mapping_bytes": os.path.getsize(os.path.join(tmp, "mapping.json")),
+                "faiss_bytes": os.path.getsize(os.path.join(tmp, "products.faiss")),
+                "python_peak_bytes": int(py_peak),
+                "maxrss_delta_kb": int(rss1 - rss0),  # only grows when a new peak is reached
+            })
+            print(out[-1])
+            del art
+    return out
+
+
+def bench_filters(n: int, repeat: int) -> list:
+    rows = _synthetic_mapping(n, np.random.default_rng(3))
+    out = []
+    for name, fn in (
+        ("type_matches.bed", lambda: [_type_matches(m, "bed") for m in rows]),
+        ("type_matches.sofa", lambda: [_type_matches(m, "Sofa") for m in rows]),
+        ("size_match", lambda: [_size_match_score(m, "Queen") for m in rows]),
+        ("color_match", lambda: [_color_match_score(m, "red") for m in rows]),
+    ):
+        r = _timeit(fn, repeat)
+        out.append({"name": f"filters.{name}", "n": n, **r, "ns_per_row": round(r["mean_ms"] * 1e6 / n, 1)})
+        print(out[-1])
+    return out
+
+
+def _compare(results: dict, baseline_path: str):
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        base = json.load(f)
+    old = {r["name"]: r for sec in base.get("results", {}).values() for r in sec}
+    print(f"\nvs {baseline_path} (ratio = new/old mean_ms, >1 is slower)")
+    for sec in results.values():
+        for r in sec:
+            o = old.get(r["name"])
+            if o and o.get("mean_ms"):
+                print(f"  {r['name']:<40} {r['mean_ms'] / o['mean_ms']:.3f}")
+
+
+# ---------------------------------------------------------------------------
+# Main
+# ---------------------------------------------------------------------------
+def main(args):
+    if args.quick:
+        search_sizes, load_sizes, batches, threads, repeat = [1_000, 10_000], [1_000], [1, 8], [1], 3
+    else:
+        search_sizes = [1_000, 10_000, 100_000, 1_000_000]
+        load_sizes = [1_000, 10_000, 100_000]
+        batches, threads, repeat = [1, 8, 32], sorted({1, max(1, (os.cpu_count() or 1) // 2), os.cpu_count() or 1}), 10
+
+    results = {}
+    if "encoder" in args.only:
+        enc = _make_encoder(args.model)
+        results["encoder"] = bench_encoder(enc, batches, threads, repeat)
+        del enc
+    dim = args.dim
+    if "search" in args.only:
+        results["search"] = bench_search(search_sizes, dim, args.k, repeat * 5, args.rerank_factor)
+    if "load" in args.only:
+        results["load"] = bench_load(load_sizes, dim)
+    if "filters" in args.only:
+        results["filters"] = bench_filters(load_sizes[-1], repeat)
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "python": platform.python_version(),
+            "torch": torch.__version__,
+            "faiss": getattr(faiss, "__version__", ""),
+            "cpu_count": os.cpu_count(),
+            "platform": platform.platform(),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Wrote {args.out}")
+
+    if args.baseline:
+        _compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--out", default="bench.json")
+    ap.add_argument("--baseline", help="Earlier bench.py JSON to compare against")
+    ap.add_argument("--quick", action="store_true", help="Small sizes for CI-style runs")
+    ap.add_argument("--model", default="random", help='"random" (offline, tiny) or a CLIP name like ViT-B/32')
+    ap.add_argument("--dim", type=int, default=512, help="Synthetic vector dimension (ViT-B/32 = 512)")
+    ap.add_argument("--k", type=int, default=60)
+    ap.add_argument("--rerank-factor", type=int, default=4)
+    ap.add_argument("--only", nargs="+", default=["encoder", "search", "load", "filters"],
+                    choices=["encoder", "search", "load", "filters"])
+    main(ap.parse_args())
@@ -0,0 +1,258 @@
+# catalog.py
+"""
+Catalog row and artifact helpers shared by index_builder (full builds) and
+the serving process (online updates / compaction).
+
+Every FAISS index written here is an IndexIDMap2 whose ids are rows of
+mapping.json, so the global index and each category partition return
+global rows directly and can be updated in place.
+"""
+import hashlib, json, os, re
+from typing import Dict, List, Optional
+
+import faiss
+import numpy as np
+from PIL import Image
+
+
+# ---------------------------------------------------------------------------
+# Product -> mapping row
+# ---------------------------------------------------------------------------
+def _looks_keep(p: str) -> bool:
+    return isinstance(p, str) and (p.endswith("/.keep") or p.endswith(".keep"))
+
+
+def _first_nonkeep(imgs):
+    if not isinstance(imgs, list):
+        return None
+    for u in imgs:
+        if isinstance(u, str) and not _looks_keep(u):
+            return u
+    return None
+
+
+def choose_lead_image(item: dict) -> Optional[str]:
+    """
+    Priority:
+      1) images[]
+      2) imagesByOption first non-.keep
+      3) defaultImagePath
+      4) heroImage
+    Returns a single http(s) or gs:// URL (may be firebasestorage.app or appspot.com).
+    """
+    u = _first_nonkeep(item.get("images") or [])
+    if u:
+        return u
+
+    ibo = item.get("imagesByOption") or {}
+    if isinstance(ibo, dict):
+        for sizes in ibo.values():
+            if isinstance(sizes, dict):
+                for arr in sizes.values():
+                    u = _first_nonkeep(arr)
+                    if u:
+                        return u
+
+    for key in ("defaultImagePath", "heroImage"):
+        v = item.get(key)
+        if isinstance(v, str) and not _looks_keep(v):
+            return v
+    return None
+
+
+def normalize_gs(url: Optional[str], bucket: Optional[str]) -> Optional[str]:
+    """Point a gs:// URL at `bucket` (image paths are stored with mixed bucket names)."""
+    if not bucket or not isinstance(url, str) or not url.startswith("gs://"):
+        return url
+    parts = url[5:].split("/", 1)
+    path = parts[1] if len(parts) > 1 else ""
+    return f"gs://{bucket}/{path}"
+
+
+def avg_lab(pil: Image.Image):
+    try:
+        im = pil.resize((96, 96)).convert("LAB")
+        arr = np.asarray(im, dtype=np.float32)
+        return [
+            float(arr[:, :, 0].mean()),
+            float(arr[:, :, 1].mean()),
+            float(arr[:, :, 2].mean()),
+        ]
+    except Exception:
+        return None
+
+
+def text_fallback(item: dict, doc_id: str) -> str:
+    """Text embedded for products whose lead image could not be fetched."""
+    name = item.get("name") or item.get("title") or doc_id
+    dept = item.get("departmentSlug") or item.get("categorySlug") or ""
+    opts = item.get("options") or {}
+    sizes = opts.get("sizes") or item.get("sizeOptions") or []
+    colors = opts.get("colors") or item.get("colorOptions") or []
+    return " ".join(
+        [
+            str(name),
+            str(dept),
+            " ".join(
+                [
+                    s.get("label") or s.get("id") or str(s)
+                    for s in sizes
+                    if isinstance(s, dict)
+                ]
+            ),
+            " ".join(
+                [
+                    c.get("label") or c.get("name") or c.get("id") or str(c)
+                    for c in colors
+                    if isinstance(c, dict)
+                ]
+            ),
+        ]
+    ).strip() or "furniture"
+
+
+def mapping_row(item: dict, lead: Optional[str], pil: Optional[Image.Image]) -> dict:
+    """mapping.json entry for a Firestore product dict (item["id"] set)."""
+    # ----- normalize options for mapping (top-level OR options.*) -----
+    opts = item.get("options") or {}
+    color_opts = item.get("colorOptions") or opts.get("colors") or []
+    size_opts = item.get("sizeOptions") or opts.get("sizes") or []
+
+    # Raw images & meta for the API to reuse
+    raw_images = item.get("images") or []
+    images_by_option = item.get("imagesByOption") or {}
+
+    return {
+        "id": item["id"],
+        "title": item.get("name") or item.get("title") or "Untitled",
+        "baseType": item.get("baseType"),
+        "departmentSlug": item.get("departmentSlug"),
+        "categorySlug": item.get("categorySlug"),
+        "materials": item.get("materials") or item.get("material") or [],
+        "seatCount": item.get("seatCount"),
+        "colorOptions": color_opts,
+        "sizeOptions": size_opts,
+        "basePrice": item.get("basePrice"),
+        # image-related fields that the API/frontend can use
+        "image": lead or "",
+        "thumbnail": item.get("thumbnail") or lead or "",
+        "defaultImagePath": item.get("defaultImagePath") or "",
+        "heroImage": item.get("heroImage") or "",
+        "images": raw_images,
+        "imagesByOption": images_by_option,
+        # precomputed average color for color-matching
+        "avg_lab": avg_lab(pil) if pil is not None else None,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Category partitions
+# ---------------------------------------------------------------------------
+def item_slugs(m: dict) -> List[str]:
+    """Lower-cased department + category slugs of a mapping row."""
+    out = []
+    for key in ("departmentSlug", "categorySlug"):
+        v = m.get(key)
+        vals = v if isinstance(v, list) else [v]
+        for s in vals:
+            if isinstance(s, str) and s.strip():
+                slug = s.strip().lower()
+                if slug not in out:
+                    out.append(slug)
+    return out
+
+
+def partition_rows(mapping: List[dict]) -> Dict[str, List[int]]:
+    part_rows: Dict[str, List[int]] = {}
+    for row, m in enumerate(mapping):
+        for slug in item_slugs(m):
+            part_rows.setdefault(slug, []).append(row)
+    return part_rows
+
+
+# ---------------------------------------------------------------------------
+# Index files
+# ---------------------------------------------------------------------------
+def idmap_index(X: np.ndarray, ids, template=None) -> faiss.IndexIDMap2:
+    """IndexIDMap2 over a flat IP index (or a clone of a trained template) holding X under ids."""
+    inner = faiss.clone_index(template) if template is not None else faiss.IndexFlatIP(X.shape[1])
+    idx = faiss.IndexIDMap2(inner)
+    if len(X):
+        idx.add_with_ids(np.ascontiguousarray(X, dtype="float32"), np.asarray(ids, dtype="int64"))
+    return idx
+
+
+def as_idmap(index, ids) -> faiss.IndexIDMap2:
+    """Wrap a plain index from older artifacts (positions == ids) as IndexIDMap2."""
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return index
+    X = index.reconstruct_n(0, index.ntotal) if index.ntotal else np.zeros((0, index.d), "float32")
+    template = faiss.clone_index(index)
+    template.reset()
+    return idmap_index(X, ids, template=template)
+
+
+def _mapping_bytes(mapping: List[dict]) -> bytes:
+    return json.dumps(mapping, ensure_ascii=False).encode("utf-8")
+
+
+def mapping_generation(mapping: List[dict]) -> str:
+    """Generation id of the mapping.json that write_artifacts writes for `mapping`."""
+    return hashlib.sha256(_mapping_bytes(mapping)).hexdigest()[:16]
+
+
+def artifact_generation(art_dir: str) -> Optional[str]:
+    """Generation id of the mapping.json on disk (None if there is none)."""
+    try:
+        with open(os.path.join(art_dir, "mapping.json"), "rb") as f:
+            return hashlib.sha256(f.read()).hexdigest()[:16]
+    except FileNotFoundError:
+        return None
+
+
+def write_artifacts(X: np.ndarray, mapping: List[dict], art_dir: str) -> str:
+    """Write products.faiss (flat, ids = rows) and mapping.json; returns the generation id."""
+    os.makedirs(art_dir, exist_ok=True)
+    faiss.write_index(idmap_index(X, np.arange(len(X))), os.path.join(art_dir, "products.faiss"))
+    data = _mapping_bytes(mapping)
+    with open(os.path.join(art_dir, "mapping.json"), "wb") as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()[:16]
+
+
+_SAFE_SLUG = re.compile(r"^[a-z0-9][a-z0-9_-]{0,63}$")
+
+
+def partition_file(slug: str) -> str:
+    """
+    File stem for a partition. Slugs come from Firestore, so anything that is
+    not a plain [a-z0-9_-] name (a "/", "..", spaces) is hashed; the real
+    slug stays in partitions.json. Hashed stems start with "_", which plain
+    names cannot, so the two never collide.
+    """
+    if _SAFE_SLUG.match(slug):
+        return slug
+    return "_" + hashlib.sha256(slug.encode("utf-8")).hexdigest()[:24]
+
+
+def write_partitions(X: np.ndarray, mapping: List[dict], art_dir: str, sq_template=None) -> dict:
+    """
+    Write one flat index per department/category slug.
+
+    partitions.json maps slug -> global rows; the vectors inside
+    <partition_file(slug)>.faiss carry those rows as ids. With sq_template (a trained, empty
+    scalar-quantized index) a quantized <slug>.sq.faiss is written next to
+    each flat one.
+    """
+    part_rows = partition_rows(mapping)
+    part_dir = os.path.join(art_dir, "partitions")
+    os.makedirs(part_dir, exist_ok=True)
+    for slug, rows in part_rows.items():
+        stem = os.path.join(part_dir, partition_file(slug))
+        faiss.write_index(idmap_index(X[rows], rows), f"{stem}.faiss")
+        if sq_template is not None:
+            faiss.write_index(idmap_index(X[rows], rows, template=sq_template), f"{stem}.sq.faiss")
+
+    with open(os.path.join(art_dir, "partitions.json"), "w", encoding="utf-8") as f:
+        json.dump(part_rows, f)
+    return part_rows
@@ -0,0 +1,263 @@
+# concepts.py
+"""
+Content-addressed store for AI-generated concept images.
+
+OpenRouter returns generated images as base64 data URLs of several MB.
+ConceptImageStore decodes such a URL once, re-encodes it as WebP (a
+full-size copy capped at max_side plus a thumbnail) and stores both under
+the SHA-256 of the decoded bytes:
+
+  <key>.webp        full image
+  <key>.thumb.webp  thumbnail
+
+so responses carry a short URL that app.py serves with immutable cache
+headers. Blobs live in a local directory or, with a bucket, under
+gs://<bucket>/<prefix>/. Once the store exceeds max_bytes the least
+recently read (local) or oldest (bucket) images are evicted.
+
+A prompt index (<prompt hash>.ref -> key) lets repeat requests for the same
+concept prompt reuse the stored image instead of generating a new one.
+"""
+import base64, hashlib, io, os, re, threading
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+NAME_RE = re.compile(r"^[0-9a-f]{32}(\.thumb)?\.webp$")
+_REF_RE = re.compile(r"^[0-9a-f]{32}$")
+
+
+def decode_data_url(url: str) -> Optional[bytes]:
+    """Bytes of a data:image/...;base64 URL, None for anything else."""
+    if not isinstance(url, str) or not url.startswith("data:image/"):
+        return None
+    head, _, payload = url.partition(",")
+    if not head.endswith(";base64") or not payload:
+        return None
+    try:
+        return base64.b64decode(payload, validate=False)
+    except ValueError:
+        return None
+
+
+def _webp(im: Image.Image, side: int, quality: int) -> bytes:
+    im = im.copy()
+    im.thumbnail((side, side), Image.LANCZOS)
+    buf = io.BytesIO()
+    im.save(buf, format="WEBP", quality=quality, method=4)
+    return buf.getvalue()
+
+
+# ---------------------------------------------------------------------------
+# Blob backends
+# ---------------------------------------------------------------------------
+class _LocalBlobs:
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def read(self, name: str) -> Optional[bytes]:
+        try:
+            with open(self._path(name), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        try:
+            os.utime(self._path(name))   # recency for eviction
+        except OSError:
+            pass
+        return data
+
+    def write(self, name: str, data: bytes, content_type: str, cache_control: str):
+        tmp = self._path(f".{name}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, self._path(name))
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self._path(name))
+
+    def delete(self, name: str):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def list(self) -> List[Tuple[str, int, float]]:
+        out = []
+        for e in os.scandir(self.root):
+            if e.is_file() and not e.name.startswith("."):
+                st = e.stat()
+                out.append((e.name, st.st_size, st.st_mtime))
+        return out
+
+
+class _GcsBlobs:
+    def __init__(self, bucket, prefix: str):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+
+    def _blob(self, name: str):
+        return self.bucket.blob(f"{self.prefix}/{name}")
+
+    def read(self, name: str) -> Optional[bytes]:
+        try:
+            return self._blob(name).download_as_bytes(timeout=30)
+        except Exception:
+            return None
+
+    def write(self, name: str, data: bytes, content_type: str, cache_control: str):
+        blob = self._blob(name)
+        blob.cache_control = cache_control
+        blob.upload_from_string(data, content_type=content_type, timeout=60)
+
+    def exists(self, name: str) -> bool:
+        return self._blob(name).exists()
+
+    def delete(self, name: str):
+        try:
+            self._blob(name).delete()
+        except Exception:
+            pass
+
+    def list(self) -> List[Tuple[str, int, float]]:
+        out = []
+        for b in self.bucket.list_blobs(prefix=f"{self.prefix}/"):
+            name = b.name.rsplit("/", 1)[-1]
+            out.append((name, int(b.size or 0), b.updated.timestamp() if b.updated else 0.0))
+        return out
+
+
+# ---------------------------------------------------------------------------
+# Store
+# ---------------------------------------------------------------------------
+class ConceptImageStore:
+    """
+    put(raw) -> key, get(name) -> bytes. The full-size copy is capped at
+    max_side px and the thumbnail at thumb_side px.
+    """
+
+    CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+    def __init__(
+        self,
+        root: str = ".cache/concepts",
+        max_bytes: int = 512 * 1024 * 1024,
+        bucket=None,
+        prefix: str = "concepts",
+        max_side: int = 1536,
+        thumb_side: int = 384,
+        quality: int = 80,
+    ):
+        self.blobs = _GcsBlobs(bucket, prefix) if bucket is not None else _LocalBlobs(root)
+        self.backend = "gcs" if bucket is not None else "local"
+        self.max_bytes = int(max_bytes)
+        self.max_side, self.thumb_side, self.quality = int(max_side), int(thumb_side), int(quality)
+
+        self._lock = threading.Lock()
+        self._bytes = sum(size for _, size, _ in self.blobs.list())
+        self.stored = self.deduped = self.evicted = self.prompt_hits = 0
+        self.bytes_in = self.bytes_out = 0
+
+    # ---------- write ----------
+
+    def put(self, raw: bytes) -> str:
+        """Store a generated image (any PIL-readable format); returns its key."""
+        key = hashlib.sha256(raw).hexdigest()[:32]
+        if self.blobs.exists(f"{key}.webp"):
+            with self._lock:
+                self.deduped += 1
+            return key
+
+        im = Image.open(io.BytesIO(raw))
+        im = im.convert("RGBA" if im.mode in ("RGBA", "LA", "P") else "RGB")
+        full = _webp(im, self.max_side, self.quality)
+        thumb = _webp(im, self.thumb_side, self.quality)
+        # thumbnail first: a visible <key>.webp implies both exist
+        self.blobs.write(f"{key}.thumb.webp", thumb, "image/webp", self.CACHE_CONTROL)
+        self.blobs.write(f"{key}.webp", full, "image/webp", self.CACHE_CONTROL)
+
+        with self._lock:
+            self.stored += 1
+            self.bytes_in += len(raw)
+            self.bytes_out += len(full) + len(thumb)
+            self._bytes += len(full) + len(thumb)
+            over = self._bytes > self.max_bytes
+        if over:
+            self._evict()
+        return key
+
+    def put_data_url(self, url: str) -> Optional[str]:
+        """put() for a base64 data URL; None if it is not one or cannot be decoded."""
+        raw = decode_data_url(url)
+        if raw is None:
+            return None
+        try:
+            return self.put(raw)
+        except Exception as e:
+            print(f"Concept image store failed: {e}")
+            return None
+
+    def _evict(self):
+        """Drop least recently used keys (image + thumbnail together) down to 90% of max_bytes."""
+        groups = {}
+        for name, size, ts in self.blobs.list():
+            g = groups.setdefault(name.split(".", 1)[0], [[], 0, 0.0])
+            g[0].append(name)
+            g[1] += size
+            g[2] = max(g[2], ts)
+        total = sum(g[1] for g in groups.values())
+        target = int(self.max_bytes * 0.9)
+        for names, size, _ in sorted(groups.values(), key=lambda g: g[2]):
+            if total <= target:
+                break
+            for name in names:
+                self.blobs.delete(name)
+            total -= size
+            with self._lock:
+                self.evicted += 1
+        with self._lock:
+            self._bytes = total
+
+    # ---------- prompt index ----------
+
+    @staticmethod
+    def _prompt_ref(prompt: str) -> str:
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:32] + ".ref"
+
+    def lookup_prompt(self, prompt: str) -> Optional[str]:
+        """Key of the image last generated for this prompt, if still stored."""
+        ref = self.blobs.read(self._prompt_ref(prompt))
+        key = ref.decode("ascii", "ignore").strip() if ref else ""
+        if not _REF_RE.match(key) or not self.blobs.exists(f"{key}.webp"):
+            return None
+        with self._lock:
+            self.prompt_hits += 1
+        return key
+
+    def remember_prompt(self, prompt: str, key: str):
+        self.blobs.write(self._prompt_ref(prompt), key.encode("ascii"), "text/plain", "no-store")
+
+    # ---------- read ----------
+
+    def get(self, name: str) -> Optional[bytes]:
+        if not NAME_RE.match(name or ""):
+            return None
+        return self.blobs.read(name)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "backend": self.backend,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "stored": self.stored,
+                "deduped": self.deduped,
+                "prompt_hits": self.prompt_hits,
+                "evicted": self.evicted,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+            }
@@ -0,0 +1,109 @@
+# filters.py
+"""
+Catalog filter helpers used by /recommend (type, size and color matching).
+
+Pure functions over mapping rows, kept free of server start-up side effects
+so they can be imported by benchmarks and tools without loading clients.
+"""
+import re
+from typing import List, Optional
+
+def _normalize(s: Optional[str]) -> str:
+    return (s or "").strip().lower()
+
+def _norm_any(v) -> str:
+    if v is None:
+        return ""
+    if isinstance(v, list):
+        v = " ".join([str(x) for x in v])
+    return str(v).strip().lower()
+
+TYPE_ALIASES = {
+    "bed": ["bedroom", "-bed", " bed"],
+    "sofa": ["sofa", " couch", "-sofa"],
+    "chair": ["chair", "-chair"],
+    "table": ["table", "-table", "dining"],
+    "bench": ["bench", "-bench"],
+    "sectional": ["sectional", "-sectional"],
+    "ottoman": ["ottoman", "-ottoman"],
+}
+
+def _type_matches(item: dict, f_type: str) -> bool:
+    if not f_type:
+        return True
+    t = _normalize(f_type)
+    dep  = _norm_any(item.get("departmentSlug"))
+    cat  = _norm_any(item.get("categorySlug"))
+    pid  = _norm_any(item.get("id"))
+    name = _norm_any(item.get("name") or item.get("title"))
+    for field in (dep, cat, pid, name):
+        if t and t in field:
+            return True
+    for token in TYPE_ALIASES.get(t, []):
+        if token in dep or token in cat or token in pid or token in name:
+            return True
+    return False
+
+def _norm_token(s: str) -> str:
+    return re.sub(r"[^a-z0-9]+", "", (s or "").lower())
+
+def _collect_size_tokens(meta: dict) -> List[str]:
+    tokens: List[str] = []
+    sizes = meta.get("sizeOptions") or []
+    if isinstance(sizes, list):
+        for s in sizes:
+            if isinstance(s, dict):
+                for key in ("label", "name", "id"):
+                    v = s.get(key)
+                    if isinstance(v, str):
+                        tokens.append(v.lower())
+            elif isinstance(s, str):
+                tokens.append(s.lower())
+    sc = meta.get("seatCount")
+    if sc:
+        try:
+            n = int(sc)
+            tokens.append(f"{n} seater")
+            tokens.append(f"{n}-seater")
+        except Exception:
+            pass
+    return tokens
+
+def _collect_color_tokens(meta: dict) -> List[str]:
+    tokens: List[str] = []
+    colors = meta.get("colorOptions") or []
+    if isinstance(colors, list):
+        for c in colors:
+            if isinstance(c, dict):
+                for key in ("label", "name", "id"):
+                    v = c.get(key)
+                    if isinstance(v, str):
+                        tokens.append(v.lower())
+            elif isinstance(c, str):
+                tokens.append(c.lower())
+    tags = meta.get("tags") or []
+    if isinstance(tags, list):
+        tokens.extend(str(t).lower() for t in tags)
+    return tokens
+
+def _size_match_score(meta: dict, pref: str) -> float:
+    if not pref:
+        return 0.0
+    pref_norm = _norm_token(pref)
+    if not pref_norm:
+        return 0.0
+    for t in _collect_size_tokens(meta):
+        if _norm_token(t) == pref_norm:
+            return 1.0
+    return 0.0
+
+def _color_match_score(meta: dict, pref: str) -> float:
+    if not pref:
+        return 0.0
+    pref_norm = _norm_token(pref)
+    if not pref_norm:
+        return 0.0
+    for t in _collect_color_tokens(meta):
+        if _norm_token(t) == pref_norm:
+            return 1.0
+    return 0.0
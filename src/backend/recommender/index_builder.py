@@ -1,184 +1,596 @@
-import argparse, os, json, io, faiss, torch
+import argparse, os, json, io, hashlib, threading, time, faiss, torch
+import multiprocessing as mp
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 import numpy as np
 from PIL import Image
 import firebase_admin
 from firebase_admin import credentials, firestore, storage
 from google.cloud import storage as gcs
 import requests
+from requests.adapters import HTTPAdapter
 import clip
 from tqdm import tqdm
 from urllib.parse import quote as urlquote
 import google.auth
 from google.auth.transport.requests import Request as GAuthRequest
 
+from catalog import (
+    choose_lead_image, idmap_index, mapping_row, normalize_gs, text_fallback, write_artifacts, write_partitions,
+)
+from model import canonical_query_texts
+from scan import iter_active_products
+
 
 # ---------------------------------------------------------------------------
 # Config (env-driven)
 # ---------------------------------------------------------------------------
 FIREBASE_BUCKET = os.getenv("FIREBASE_BUCKET", "").strip()   # e.g. furnitune-64458.firebasestorage.app
+SCAN_PARTITIONS = int(os.getenv("SCAN_PARTITIONS", "4"))      # concurrent Firestore readers
+BLOB_CACHE_DIR = os.getenv("BLOB_CACHE_DIR", ".cache/blobs")  # "" disables the on-disk image cache
+CLIP_MODEL = "ViT-B/32"
+ENCODE_BATCH = int(os.getenv("ENCODE_BATCH", "32"))
+WORKER_LOAD_TIMEOUT_S = float(os.getenv("WORKER_LOAD_TIMEOUT_S", "600"))  # CLIP load per encode worker
 
 
 # ---------------------------------------------------------------------------
 # Small helpers
 # ---------------------------------------------------------------------------
-def _looks_keep(p: str) -> bool:
-    return isinstance(p, str) and (p.endswith("/.keep") or p.endswith(".keep"))
-
-
-def _first_nonkeep(imgs):
-    if not isinstance(imgs, list):
-        return None
-    for u in imgs:
-        if isinstance(u, str) and not _looks_keep(u):
-            return u
-    return None
-
-
-def _choose_lead_image(item: dict) -> str | None:
-    """
-    Priority:
-      1) images[]
-      2) imagesByOption first non-.keep
-      3) defaultImagePath
-      4) heroImage
-    Returns a single http(s) or gs:// URL (may be firebasestorage.app or appspot.com).
-    """
-    u = _first_nonkeep(item.get("images") or [])
-    if u:
-        return u
-
-    ibo = item.get("imagesByOption") or {}
-    if isinstance(ibo, dict):
-        for sizes in ibo.values():
-            if isinstance(sizes, dict):
-                for arr in sizes.values():
-                    u = _first_nonkeep(arr)
-                    if u:
-                        return u
-
-    for key in ("defaultImagePath", "heroImage"):
-        v = item.get(key)
-        if isinstance(v, str) and not _looks_keep(v):
-            return v
-    return None
-
-
 def _normalize_gs(gs_url: str, project: str) -> str:
     """
     Normalize any gs:// URL to use the actual bucket we were given (env),
     otherwise fallback to <project>.appspot.com.
     """
-    if not isinstance(gs_url, str) or not gs_url.startswith("gs://"):
-        return gs_url
-    rest = gs_url[5:]
-    parts = rest.split("/", 1)
-    path = parts[1] if len(parts) > 1 else ""
-    bucket = FIREBASE_BUCKET or f"{project}.appspot.com"
-    return f"gs://{bucket}/{path}"
-
-
-def _avg_lab(pil: Image.Image):
-    try:
-        im = pil.resize((96, 96)).convert("LAB")
-        arr = np.asarray(im, dtype=np.float32)
-        return [
-            float(arr[:, :, 0].mean()),
-            float(arr[:, :, 1].mean()),
-            float(arr[:, :, 2].mean()),
-        ]
-    except Exception:
-        return None
-
-
-def _get_access_token() -> str | None:
-    """OAuth token suitable for GCS JSON API downloads."""
-    try:
-        scopes = ["https://www.googleapis.com/auth/devstorage.read_only"]
-        creds, _ = google.auth.default(scopes=scopes)
-        if not creds.valid:
-            creds.refresh(GAuthRequest())
-        return creds.token
-    except Exception:
-        return None
+    return normalize_gs(gs_url, FIREBASE_BUCKET or f"{project}.appspot.com")
 
 
 # ---------------------------------------------------------------------------
 # Robust image downloader
 # ---------------------------------------------------------------------------
-def _download_image_any(u: str, gcs_client: gcs.Client, bucket_default) -> Image.Image | None:
+class ImageDownloader:
     """
-    Try in order:
+    Fetches product images for the builder.
+
+    Try in order (per bucket, the step that last worked is tried first):
       1) http(s) direct
       2) gs:// via GCS JSON API (OAuth)
       3) gs:// via Signed URL + requests.get
       4) gs:// via Admin SDK download_to_file
+
+    Reuses one OAuth credential until it expires and one pooled HTTP session
+    for every request. Bytes are kept in an on-disk blob cache keyed by the
+    object path; cached entries are revalidated with their ETag/generation
+    so unchanged images come back as 304s instead of full downloads. URLs
+    that fail NEG_CACHE_FAILS builds in a row are skipped for NEG_CACHE_TTL.
     """
-    try:
-        # 1) http(s)
-        if isinstance(u, str) and u.startswith("http"):
-            r = requests.get(u, timeout=20)
-            r.raise_for_status()
-            return Image.open(io.BytesIO(r.content)).convert("RGB")
 
-        # 2/3/4) gs://
-        if isinstance(u, str) and u.startswith("gs://"):
-            rest = u[5:]
-            bkt, path = rest.split("/", 1)
-
-            # If it's firebasestorage.app, convert to the real bucket name we use
-            if bkt.endswith(".firebasestorage.app"):
-                proj = bkt.split(".")[0]
-                bkt_norm = FIREBASE_BUCKET or f"{proj}.appspot.com"
-            else:
-                bkt_norm = FIREBASE_BUCKET or bkt
+    STEPS = ("json_api", "signed_url", "admin_sdk")
+    NEG_CACHE_FAILS = 3
+    NEG_CACHE_TTL = 24 * 3600
 
-            # 2) GCS JSON API (IAM, bypasses Firebase rules)
-            try:
-                tok = _get_access_token()
-                if tok:
-                    gcs_url = (
-                        f"https://storage.googleapis.com/download/storage/v1/b/"
-                        f"{bkt_norm}/o/{urlquote(path, safe='')}"
-                    )
-                    r = requests.get(
-                        gcs_url,
-                        params={"alt": "media"},
-                        headers={"Authorization": f"Bearer {tok}"},
-                        timeout=20,
-                    )
-                    if r.status_code == 200 and r.content:
-                        return Image.open(io.BytesIO(r.content)).convert("RGB")
-            except Exception:
-                pass
+    def __init__(self, gcs_client: gcs.Client, bucket_default, cache_dir: str | None = BLOB_CACHE_DIR):
+        self.gcs_client = gcs_client
+        self.bucket_default = bucket_default
+        self.cache_dir = cache_dir or None
+
+        self._creds = None
+        self._lock = threading.Lock()
+        self._bucket_step: dict[str, str] = {}
 
-            # 3) Signed URL (useful if IAM is fine but token path fails)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._negative: dict[str, dict] = {}
+        if self.cache_dir:
+            os.makedirs(self.cache_dir, exist_ok=True)
             try:
-                blob = gcs_client.bucket(bkt_norm).blob(path)
-                url = blob.generate_signed_url(
-                    version="v4",
-                    expiration=900,
-                    method="GET",
-                )
-                r = requests.get(url, timeout=20)
-                r.raise_for_status()
-                return Image.open(io.BytesIO(r.content)).convert("RGB")
+                with open(self._negative_path(), "r", encoding="utf-8") as f:
+                    self._negative = json.load(f)
             except Exception:
-                pass
+                self._negative = {}
+
+        self.stats = {"downloaded": 0, "revalidated": 0, "negative_skip": 0, "failed": 0}
+
+    # ---------- credentials ----------
 
-            # 4) Admin SDK fallback
+    def _access_token(self) -> str | None:
+        """OAuth token suitable for GCS JSON API downloads, refreshed only on expiry."""
+        with self._lock:
             try:
-                bucket = storage.bucket(bkt_norm) if bkt_norm else bucket_default
-                buf = io.BytesIO()
-                bucket.blob(path).download_to_file(buf)
-                buf.seek(0)
-                return Image.open(buf).convert("RGB")
+                if self._creds is None:
+                    scopes = ["https://www.googleapis.com/auth/devstorage.read_only"]
+                    self._creds, _ = google.auth.default(scopes=scopes)
+                if not self._creds.valid:
+                    self._creds.refresh(GAuthRequest())
+                return self._creds.token
             except Exception:
                 return None
 
-    except Exception:
+    # ---------- blob cache ----------
+
+    def _cache_file(self, key: str, ext: str) -> str:
+        h = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, h[:2], f"{h}.{ext}")
+
+    def _cache_get(self, key: str) -> tuple[bytes | None, dict]:
+        if not self.cache_dir:
+            return None, {}
+        try:
+            with open(self._cache_file(key, "json"), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            with open(self._cache_file(key, "bin"), "rb") as f:
+                return f.read(), meta
+        except Exception:
+            return None, {}
+
+    def _cache_put(self, key: str, data: bytes, etag: str | None = None, generation: str | None = None):
+        if not self.cache_dir or not (etag or generation):
+            return
+        try:
+            path = self._cache_file(key, "bin")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+            with open(self._cache_file(key, "json"), "w", encoding="utf-8") as f:
+                json.dump({"key": key, "etag": etag, "generation": generation}, f)
+        except Exception:
+            pass
+
+    # ---------- negative cache ----------
+
+    def _negative_path(self) -> str:
+        return os.path.join(self.cache_dir, "negative.json")
+
+    def _is_negative(self, u: str) -> bool:
+        ent = self._negative.get(u)
+        if not ent or ent.get("fails", 0) < self.NEG_CACHE_FAILS:
+            return False
+        if time.time() - ent.get("ts", 0) > self.NEG_CACHE_TTL:
+            return False
+        return True
+
+    def _record(self, u: str, ok: bool):
+        with self._lock:
+            if ok:
+                self._negative.pop(u, None)
+            else:
+                ent = self._negative.setdefault(u, {"fails": 0, "ts": 0})
+                ent["fails"] += 1
+                ent["ts"] = time.time()
+
+    def save(self):
+        """Persist the negative cache so the next build can skip dead URLs."""
+        if not self.cache_dir:
+            return
+        try:
+            with open(self._negative_path(), "w", encoding="utf-8") as f:
+                json.dump(self._negative, f)
+        except Exception:
+            pass
+
+    # ---------- fetch steps ----------
+
+    def _get_http(self, url: str, key: str, cached: bytes | None, meta: dict, **kw) -> bytes | None:
+        headers = dict(kw.pop("headers", {}) or {})
+        if cached is not None and meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        r = self.session.get(url, headers=headers, timeout=20, **kw)
+        if r.status_code == 304 and cached is not None:
+            self.stats["revalidated"] += 1
+            return cached
+        r.raise_for_status()
+        if not r.content:
+            return None
+        self._cache_put(key, r.content, r.headers.get("ETag"), r.headers.get("x-goog-generation"))
+        self.stats["downloaded"] += 1
+        return r.content
+
+    def _step_json_api(self, bkt: str, path: str, key: str, cached, meta) -> bytes | None:
+        tok = self._access_token()
+        if not tok:
+            return None
+        gcs_url = (
+            f"https://storage.googleapis.com/download/storage/v1/b/"
+            f"{bkt}/o/{urlquote(path, safe='')}"
+        )
+        params = {"alt": "media"}
+        if cached is not None and meta.get("generation"):
+            params["ifGenerationNotMatch"] = meta["generation"]
+        return self._get_http(
+            gcs_url, key, cached, meta,
+            params=params, headers={"Authorization": f"Bearer {tok}"},
+        )
+
+    def _step_signed_url(self, bkt: str, path: str, key: str, cached, meta) -> bytes | None:
+        blob = self.gcs_client.bucket(bkt).blob(path)
+        url = blob.generate_signed_url(version="v4", expiration=900, method="GET")
+        return self._get_http(url, key, cached, meta)
+
+    def _step_admin_sdk(self, bkt: str, path: str, key: str, cached, meta) -> bytes | None:
+        bucket = storage.bucket(bkt) if bkt else self.bucket_default
+        blob = bucket.blob(path)
+        buf = io.BytesIO()
+        blob.download_to_file(buf)
+        data = buf.getvalue()
+        gen = str(blob.generation) if blob.generation else None
+        self._cache_put(key, data, blob.etag, gen)
+        self.stats["downloaded"] += 1
+        return data
+
+    def _fetch_bytes(self, u: str) -> bytes | None:
+        # 1) http(s)
+        if u.startswith("http"):
+            cached, meta = self._cache_get(u)
+            return self._get_http(u, u, cached, meta)
+
+        # 2/3/4) gs://
+        if not u.startswith("gs://"):
+            return None
+        rest = u[5:]
+        bkt, path = rest.split("/", 1)
+
+        # If it's firebasestorage.app, convert to the real bucket name we use
+        if bkt.endswith(".firebasestorage.app"):
+            proj = bkt.split(".")[0]
+            bkt_norm = FIREBASE_BUCKET or f"{proj}.appspot.com"
+        else:
+            bkt_norm = FIREBASE_BUCKET or bkt
+
+        key = f"gs://{bkt_norm}/{path}"
+        cached, meta = self._cache_get(key)
+
+        preferred = self._bucket_step.get(bkt_norm)
+        order = ([preferred] if preferred else []) + [s for s in self.STEPS if s != preferred]
+        for step in order:
+            try:
+                data = getattr(self, f"_step_{step}")(bkt_norm, path, key, cached, meta)
+            except Exception:
+                data = None
+            if data:
+                self._bucket_step[bkt_norm] = step
+                return data
         return None
 
-    return None
+    # ---------- public API ----------
+
+    def download(self, u: str) -> Image.Image | None:
+        """Return the image at u as RGB PIL, or None if every step failed."""
+        if not isinstance(u, str) or not u:
+            return None
+        if self._is_negative(u):
+            self.stats["negative_skip"] += 1
+            return None
+        try:
+            data = self._fetch_bytes(u)
+            pil = Image.open(io.BytesIO(data)).convert("RGB") if data else None
+        except Exception:
+            pil = None
+        self._record(u, pil is not None)
+        if pil is None:
+            self.stats["failed"] += 1
+        return pil
+
+# ---------------------------------------------------------------------------
+# Scalar-quantized index
+# ---------------------------------------------------------------------------
+QUANT_TYPES = {"fp16": "QT_fp16", "int8": "QT_8bit"}
+
+
+def _sq_template(X: np.ndarray, quantize: str):
+    """Empty IndexScalarQuantizer trained on the whole catalog (shared by partitions)."""
+    qt = getattr(faiss.ScalarQuantizer, QUANT_TYPES[quantize])
+    idx = faiss.IndexScalarQuantizer(X.shape[1], qt, faiss.METRIC_INNER_PRODUCT)
+    idx.train(X)
+    return idx
+
+
+def _topk_agreement(X: np.ndarray, flat, sq, k: int = 10, n_queries: int = 200, rerank_factor: int = 4) -> dict:
+    """Mean overlap@k of the quantized scan (with and without exact rerank) vs the flat index."""
+    rng = np.random.default_rng(0)
+    qi = rng.choice(len(X), size=min(n_queries, len(X)), replace=False)
+    Q = X[qi]
+    k = min(k, len(X))
+    _, I_flat = flat.search(Q, k)
+    _, I_sq = sq.search(Q, k)
+    _, I_cand = sq.search(Q, min(k * rerank_factor, len(X)))
+
+    plain = rerank = 0.0
+    for j in range(len(Q)):
+        truth = set(I_flat[j].tolist())
+        plain += len(truth & set(I_sq[j].tolist())) / k
+        cand = [r for r in I_cand[j].tolist() if r >= 0]
+        exact = X[cand] @ Q[j]
+        top = [cand[i] for i in np.argsort(-exact)[:k]]
+        rerank += len(truth & set(top)) / k
+    return {
+        "k": k,
+        "queries": int(len(Q)),
+        "rerank_factor": rerank_factor,
+        "agreement_sq": round(plain / len(Q), 4),
+        "agreement_sq_rerank": round(rerank / len(Q), 4),
+    }
+
+
+def _write_quantized(X: np.ndarray, flat, art_dir: str, quantize: str):
+    """
+    Write products.sq.faiss, vectors.f32 (row-major float32 for memory-mapped
+    exact rescoring) and quantization_report.json. Returns the trained template.
+    """
+    template = _sq_template(X, quantize)
+    sq = idmap_index(X, np.arange(len(X)), template=template)
+    faiss.write_index(sq, os.path.join(art_dir, "products.sq.faiss"))
+    np.ascontiguousarray(X, dtype="float32").tofile(os.path.join(art_dir, "vectors.f32"))
+
+    def _size(name):
+        return os.path.getsize(os.path.join(art_dir, name))
+
+    report = {
+        "quantize": quantize,
+        "rows": int(X.shape[0]),
+        "dim": int(X.shape[1]),
+        # flat/sq indexes are held fully in RAM; vectors.f32 is only paged in for reranked rows
+        "bytes": {
+            "products.faiss": _size("products.faiss"),
+            "products.sq.faiss": _size("products.sq.faiss"),
+            "vectors.f32": _size("vectors.f32"),
+        },
+        **_topk_agreement(X, flat, sq),
+    }
+    with open(os.path.join(art_dir, "quantization_report.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print("Quantization: " + json.dumps(report))
+    return template
+
+
+# ---------------------------------------------------------------------------
+# Canonical query cache
+# ---------------------------------------------------------------------------
+def _write_query_cache(model, device, mapping: list, art_dir: str, batch: int = 256) -> int:
+    """Batch-encode every guided-form query string into query_cache.npz."""
+    keys = canonical_query_texts(mapping)
+    out = []
+    with torch.no_grad():
+        for i in range(0, len(keys), batch):
+            tokens = clip.tokenize(keys[i : i + batch], truncate=True).to(device)
+            z = model.encode_text(tokens)
+            z = z / z.norm(dim=-1, keepdim=True)
+            out.append(z.float().cpu().numpy())
+    vecs = np.concatenate(out, axis=0).astype("float32")
+    np.savez(os.path.join(art_dir, "query_cache.npz"), keys=np.array(keys), vecs=vecs)
+    return len(keys)
+
+
+# ---------------------------------------------------------------------------
+# Image encoding (in-process or multi-process)
+# ---------------------------------------------------------------------------
+def _prefetch(items: list, fn, workers: int, window: int | None = None):
+    """Yield (item, fn(item)) in order while up to `window` calls run ahead on threads."""
+    window = window or 2 * workers
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        it = iter(items)
+        for x in it:
+            pending.append((x, pool.submit(fn, x)))
+            if len(pending) >= window:
+                break
+        while pending:
+            x, fut = pending.popleft()
+            nxt = next(it, None)
+            if nxt is not None:
+                pending.append((nxt, pool.submit(fn, nxt)))
+            yield x, fut.result()
+
+
+class _InProcessImageEncoder:
+    """Batches images through the parent's CLIP model into rows of `out`."""
+
+    def __init__(self, model, preprocess, device, n: int, dim: int, batch: int = ENCODE_BATCH):
+        self.model, self.preprocess, self.device = model, preprocess, device
+        self.out = np.zeros((n, dim), dtype="float32")
+        self.batch = batch
+        self._rows, self._imgs = [], []
+
+    def submit(self, row: int, pil: Image.Image):
+        self._rows.append(row)
+        self._imgs.append(pil)
+        if len(self._rows) >= self.batch:
+            self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        with torch.no_grad():
+            x = torch.stack([self.preprocess(im) for im in self._imgs]).to(self.device)
+            z = self.model.encode_image(x)
+            z = z / z.norm(dim=-1, keepdim=True)
+        self.out[self._rows] = z.float().cpu().numpy()
+        self._rows, self._imgs = [], []
+
+    def finish(self) -> np.ndarray:
+        self._flush()
+        return self.out
+
+
+def _shrink_for_clip(pil: Image.Image, side: int) -> Image.Image:
+    """
+    Downscale so the short side is `side`, the same bicubic resize CLIP's
+    preprocess starts with (which is then a no-op), so batches hold
+    ~side x 1.5*side images instead of full-resolution photos.
+    """
+    w, h = pil.size
+    short, long = min(w, h), max(w, h)
+    if short <= side:
+        return pil
+    long = int(side * long / short)
+    return pil.resize((side, long) if w <= h else (long, side), Image.BICUBIC)
+
+
+def _encode_worker(model_name: str, threads: int, shm_name: str, n: int, dim: int, in_q, out_q):
+    """Worker process: load CLIP once, encode batches, write vectors into shared memory."""
+    try:
+        torch.set_num_threads(threads)
+        model, preprocess = clip.load(model_name, device="cpu", jit=False)
+        model.eval()
+    except Exception as e:
+        out_q.put(f"error: {e}")
+        raise
+    shm = shared_memory.SharedMemory(name=shm_name)
+    out = np.ndarray((n, dim), dtype=np.float32, buffer=shm.buf)
+    # the only message besides a load error: nothing is queued per batch, so
+    # the result pipe never fills up and blocks the worker at exit
+    out_q.put("ready")
+    try:
+        while True:
+            job = in_q.get()
+            if job is None:
+                break
+            rows, imgs = job
+            with torch.no_grad():
+                x = torch.stack([preprocess(im) for im in imgs])
+                z = model.encode_image(x)
+                z = z / z.norm(dim=-1, keepdim=True)
+            out[rows] = z.float().numpy()
+    finally:
+        del out
+        shm.close()
+
+
+class _MultiProcImageEncoder:
+    """
+    N worker processes, each with its own CLIP and cores/N torch threads,
+    pull image batches from a bounded queue and write unit vectors straight
+    into a shared (n, dim) float32 buffer at their original row positions,
+    so only decoded images cross the process boundary, never tensors.
+    """
+
+    def __init__(self, procs: int, n: int, dim: int, batch: int = ENCODE_BATCH, model_name: str = CLIP_MODEL):
+        ctx = mp.get_context("spawn")
+        self.n, self.dim, self.batch = n, dim, batch
+        self.shm = shared_memory.SharedMemory(create=True, size=max(1, n * dim * 4))
+        self.out = np.ndarray((n, dim), dtype=np.float32, buffer=self.shm.buf)
+        self.out[:] = 0.0
+        self.in_q = ctx.Queue(maxsize=2 * procs)
+        self.out_q = ctx.Queue()
+        threads = max(1, (os.cpu_count() or 1) // procs)
+        self.procs = [
+            ctx.Process(
+                target=_encode_worker,
+                args=(model_name, threads, self.shm.name, n, dim, self.in_q, self.out_q),
+                daemon=True,
+            )
+            for _ in range(procs)
+        ]
+        for p in self.procs:
+            p.start()
+        self._wait_ready()
+        self._rows, self._imgs = [], []
+
+    # Every blocking call polls with a short timeout and checks the workers,
+    # so a worker that fails to load CLIP or is OOM-killed aborts the build
+    # instead of hanging it.
+
+    def _check_workers(self):
+        dead = [p.exitcode for p in self.procs if p.exitcode is not None and p.exitcode != 0]
+        if dead:
+            self._abort(f"Encoder worker(s) died with exit code {dead}")
+
+    def _abort(self, msg: str):
+        for p in self.procs:
+            if p.is_alive():
+                p.terminate()
+        for p in self.procs:
+            p.join(timeout=5)
+        del self.out
+        self.shm.close()
+        self.shm.unlink()
+        raise SystemExit(msg)
+
+    def _wait_ready(self):
+        deadline = time.monotonic() + WORKER_LOAD_TIMEOUT_S
+        ready = 0
+        while ready < len(self.procs):
+            try:
+                msg = self.out_q.get(timeout=1.0)
+            except queue.Empty:
+                self._check_workers()
+                if any(not p.is_alive() for p in self.procs):
+                    self._abort("Encoder worker exited before loading CLIP")
+                if time.monotonic() > deadline:
+                    self._abort(f"Encoder workers not ready after {WORKER_LOAD_TIMEOUT_S:.0f}s")
+                continue
+            if msg != "ready":
+                self._abort(f"Encoder worker failed to start ({msg})")
+            ready += 1
+
+    def _put(self, job):
+        while True:
+            try:
+                self.in_q.put(job, timeout=1.0)
+                return
+            except queue.Full:
+                self._check_workers()
+
+    def submit(self, row: int, pil: Image.Image):
+        self._rows.append(row)
+        self._imgs.append(pil)
+        if len(self._rows) >= self.batch:
+            self._flush()
+
+    def _flush(self):
+        if self._rows:
+            self._put((self._rows, self._imgs))
+            self._rows, self._imgs = [], []
+
+    def finish(self) -> np.ndarray:
+        self._flush()
+        for _ in self.procs:
+            self._put(None)
+        for p in self.procs:
+            while p.is_alive():
+                p.join(timeout=1.0)
+                self._check_workers()
+        self._check_workers()
+        result = np.array(self.out, copy=True)
+        del self.out
+        self.shm.close()
+        self.shm.unlink()
+        return result
+
+
+def _make_image_encoder(procs: int, model, preprocess, device, n: int, dim: int):
+    if procs > 1 and device == "cpu":
+        return _MultiProcImageEncoder(procs, n, dim)
+    return _InProcessImageEncoder(model, preprocess, device, n, dim)
+
+
+def _compare_encoders(procs: int, model, preprocess, device, sample: list, dim: int):
+    """Encode the same images single- and multi-process and print the speedup."""
+    n = len(sample)
+    single = _InProcessImageEncoder(model, preprocess, device, n, dim)
+    t0 = time.perf_counter()
+    for i, im in enumerate(sample):
+        single.submit(i, im)
+    a = single.finish()
+    t_single = time.perf_counter() - t0
+
+    multi = _MultiProcImageEncoder(procs, n, dim)   # model load excluded from timing
+    t0 = time.perf_counter()
+    for i, im in enumerate(sample):
+        multi.submit(i, im)
+    b = multi.finish()
+    t_multi = time.perf_counter() - t0
+
+    print(
+        f"Encode speedup on {n} images: single={n / t_single:.1f} img/s "
+        f"procs={procs}: {n / t_multi:.1f} img/s  x{t_single / t_multi:.2f}  "
+        f"max|diff|={float(np.abs(a - b).max()):.2e}"
+    )
 
 
 # ---------------------------------------------------------------------------
@@ -207,129 +619,115 @@ def main(args):
     db = firestore.client()
     bucket_default = storage.bucket(bucket_name)   # Admin SDK bucket
     gcs_client = gcs.Client(project=args.project)  # google-cloud-storage client
+    downloader = ImageDownloader(gcs_client, bucket_default, cache_dir=args.blob_cache)
 
     # CLIP
     device = "cuda" if torch.cuda.is_available() else "cpu"
-    model, preprocess = clip.load("ViT-B/32", device=device, jit=False)
+    model, preprocess = clip.load(CLIP_MODEL, device=device, jit=False)
     model.eval()
+    dim = int(model.visual.output_dim)
 
     # Products
-    docs = db.collection("products").where("active", "==", True).stream()
+    docs = list(tqdm(iter_active_products(db, args.partitions), desc="Reading products"))
+    total = len(docs)
 
-    vecs, mapping = [], []
-    embedded_img = embedded_txt = total = 0
+    clip_side = int(model.visual.input_resolution)
 
-    for d in tqdm(docs, desc="Embedding products"):
-        total += 1
+    def _fetch(d):
         item = d.to_dict() or {}
         item["id"] = d.id
 
         # Choose a lead image and normalize gs:// to our bucket
-        lead = _choose_lead_image(item)
+        lead = choose_lead_image(item)
         if isinstance(lead, str) and lead.startswith("gs://"):
             lead = _normalize_gs(lead, args.project)
 
-        # Try to fetch the image
-        pil = (
-            _download_image_any(lead, gcs_client, bucket_default)
-            if isinstance(lead, str) and lead
-            else None
-        )
+        # Try to fetch the image; the row (avg_lab) sees full resolution, the
+        # encoder queue and --compare-single sample only the CLIP-sized copy
+        pil = downloader.download(lead)
+        row = mapping_row(item, lead, pil)
+        return item, row, _shrink_for_clip(pil, clip_side) if pil is not None else None
+
+    img_encoder = _make_image_encoder(args.encode_procs, model, preprocess, device, total, dim)
+    t_encode = time.perf_counter()
+
+    mapping, text_rows, texts, sample = [], [], [], []
+    embedded_img = embedded_txt = 0
+
+    for row, (d, (item, mrow, pil)) in enumerate(
+        tqdm(_prefetch(docs, _fetch, args.download_workers), total=total, desc="Embedding products")
+    ):
+        if pil is not None:
+            img_encoder.submit(row, pil)
+            if args.compare_single and len(sample) < 256:
+                sample.append(pil)
+            embedded_img += 1
+        else:
+            # Text fallback if no image
+            text_rows.append(row)
+            texts.append(text_fallback(item, d.id))
+            embedded_txt += 1
+
+        mapping.append(mrow)
+
+    X = img_encoder.finish()
+    t_encode = time.perf_counter() - t_encode
+    print(f"Encoded {embedded_img} images in {t_encode:.1f}s (encode_procs={args.encode_procs}, incl. downloads)")
+
+    with torch.no_grad():
+        for i in range(0, len(texts), ENCODE_BATCH):
+            tokens = clip.tokenize(texts[i : i + ENCODE_BATCH], truncate=True).to(device)
+            z = model.encode_text(tokens)
+            z = z / z.norm(dim=-1, keepdim=True)
+            X[text_rows[i : i + ENCODE_BATCH]] = z.float().cpu().numpy()
+
+    if args.compare_single and sample and args.encode_procs > 1:
+        _compare_encoders(args.encode_procs, model, preprocess, device, sample, dim)
+
+    downloader.save()
+
+    if total == 0:
+        raise SystemExit("No vectors generated. Check your bucket name and image fields.")
 
-        with torch.no_grad():
-            if pil is not None:
-                x = preprocess(pil).unsqueeze(0).to(device)
-                z = model.encode_image(x)
-                z = z / z.norm(dim=-1, keepdim=True)
-                vec = z.cpu().numpy().astype("float32")
-                embedded_img += 1
-            else:
-                # Text fallback if no image
-                name = item.get("name") or item.get("title") or d.id
-                dept = item.get("departmentSlug") or item.get("categorySlug") or ""
-                opts = item.get("options") or {}
-                sizes = opts.get("sizes") or item.get("sizeOptions") or []
-                colors = opts.get("colors") or item.get("colorOptions") or []
-                text = " ".join(
-                    [
-                        str(name),
-                        str(dept),
-                        " ".join(
-                            [
-                                s.get("label") or s.get("id") or str(s)
-                                for s in sizes
-                                if isinstance(s, dict)
-                            ]
-                        ),
-                        " ".join(
-                            [
-                                c.get("label") or c.get("name") or c.get("id") or str(c)
-                                for c in colors
-                                if isinstance(c, dict)
-                            ]
-                        ),
-                    ]
-                ).strip() or "furniture"
-                tokens = clip.tokenize([text], truncate=True).to(device)
-                z = model.encode_text(tokens)
-                z = z / z.norm(dim=-1, keepdim=True)
-                vec = z.cpu().numpy().astype("float32")
-                embedded_txt += 1
-
-        vecs.append(vec)
-
-        # ----- normalize options for mapping (top-level OR options.*) -----
-        opts = item.get("options") or {}
-        color_opts = item.get("colorOptions") or opts.get("colors") or []
-        size_opts = item.get("sizeOptions") or opts.get("sizes") or []
-
-        # Raw images & meta for the API to reuse
-        raw_images = item.get("images") or []
-        images_by_option = item.get("imagesByOption") or {}
-
-        mapping.append(
-            {
-                "id": item["id"],
-                "title": item.get("name") or item.get("title") or "Untitled",
-                "baseType": item.get("baseType"),
-                "departmentSlug": item.get("departmentSlug"),
-                "categorySlug": item.get("categorySlug"),
-                "materials": item.get("materials") or item.get("material") or [],
-                "seatCount": item.get("seatCount"),
-                "colorOptions": color_opts,
-                "sizeOptions": size_opts,
-                "basePrice": item.get("basePrice"),
-                # image-related fields that the API/frontend can use
-                "image": lead or "",
-                "thumbnail": item.get("thumbnail") or lead or "",
-                "defaultImagePath": item.get("defaultImagePath") or "",
-                "heroImage": item.get("heroImage") or "",
-                "images": raw_images,
-                "imagesByOption": images_by_option,
-                # precomputed average color for color-matching
-                "avg_lab": _avg_lab(pil) if pil is not None else None,
-            }
-        )
+    # cosine (unit vectors, because we L2-normalized); ids = mapping rows so
+    # the serving process can add/remove products in place
+    write_artifacts(X, mapping, "artifacts")
 
-    if not vecs:
-        raise SystemExit("No vectors generated. Check your bucket name and image fields.")
+    print("Wrote artifacts/products.faiss and artifacts/mapping.json")
 
-    X = np.concatenate(vecs, axis=0)
-    index = faiss.IndexFlatIP(X.shape[1])   # cosine (unit vectors, because we L2-normalized)
-    index.add(X)
+    sq_template = None
+    if args.quantize:
+        flat = faiss.IndexFlatIP(X.shape[1])
+        flat.add(X)
+        sq_template = _write_quantized(X, flat, "artifacts", args.quantize)
 
-    os.makedirs("artifacts", exist_ok=True)
-    faiss.write_index(index, "artifacts/products.faiss")
-    with open("artifacts/mapping.json", "w", encoding="utf-8") as f:
-        json.dump(mapping, f, ensure_ascii=False)
+    if args.partitions_index:
+        parts = write_partitions(X, mapping, "artifacts", sq_template=sq_template)
+        print(f"Wrote {len(parts)} category partitions to artifacts/partitions/")
 
-    print("Wrote artifacts/products.faiss and artifacts/mapping.json")
+    n_queries = _write_query_cache(model, device, mapping, "artifacts")
+    print(f"Wrote {n_queries} canonical query vectors to artifacts/query_cache.npz")
     print(
         f"Summary: total={total} embedded_img={embedded_img} embedded_txt={embedded_txt}"
     )
+    print("Downloads: " + " ".join(f"{k}={v}" for k, v in downloader.stats.items()))
 
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument("--project", required=True)
+    ap.add_argument("--partitions", type=int, default=SCAN_PARTITIONS,
+                    help="Concurrent Firestore readers (1 = single sequential cursor)")
+    ap.add_argument("--no-partitions-index", dest="partitions_index", action="store_false",
+                    help="Skip writing per-category sub-indexes")
+    ap.add_argument("--quantize", choices=sorted(QUANT_TYPES), default=None,
+                    help="Also write a scalar-quantized index + float32 vectors for reranking")
+    ap.add_argument("--encode-procs", type=int, default=1,
+                    help="CLIP worker processes for image encoding (CPU only; 1 = in-process)")
+    ap.add_argument("--download-workers", type=int, default=8,
+                    help="Threads downloading images ahead of the encoder")
+    ap.add_argument("--compare-single", action="store_true",
+                    help="With --encode-procs > 1, report speedup vs the single-process path")
+    ap.add_argument("--blob-cache", default=BLOB_CACHE_DIR,
+                    help="Directory for cached image bytes (empty string disables)")
     main(ap.parse_args())
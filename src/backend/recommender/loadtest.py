@@ -0,0 +1,82 @@
+# loadtest.py
+"""
+Closed-loop HTTP load generator for comparing serving modes.
+
+Start the same artifacts under both servers on the same number of cores, e.g.
+  gunicorn -w 1 -k gthread --threads 8 -b 0.0.0.0:8080 app:app
+  uvicorn asgi:app --host 0.0.0.0 --port 8081 --workers 1
+then run
+  python loadtest.py --url http://localhost:8080/recommend --concurrency 16
+  python loadtest.py --url http://localhost:8081/recommend --concurrency 16
+
+Prints a JSON summary (throughput, latency percentiles, status counts).
+"""
+import argparse, base64, json, threading, time
+from collections import Counter
+
+import requests
+
+
+def _percentile(xs, q):
+    if not xs:
+        return 0.0
+    xs = sorted(xs)
+    i = min(len(xs) - 1, max(0, int(round(q * (len(xs) - 1)))))
+    return xs[i]
+
+
+def main(args):
+    body = {"text": args.text, "type": args.type, "k": args.k}
+    if args.image:
+        with open(args.image, "rb") as f:
+            body["image_b64"] = base64.b64encode(f.read()).decode("ascii")
+
+    lat, codes = [], Counter()
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + args.duration
+
+    def worker():
+        s = requests.Session()
+        while time.perf_counter() < stop_at:
+            t0 = time.perf_counter()
+            try:
+                r = s.post(args.url, json=body, timeout=60)
+                code = r.status_code
+            except Exception:
+                code = "error"
+            dt = time.perf_counter() - t0
+            with lock:
+                codes[code] += 1
+                if code == 200:
+                    lat.append(dt)
+
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    t0 = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+
+    print(json.dumps({
+        "url": args.url,
+        "concurrency": args.concurrency,
+        "duration_s": round(wall, 2),
+        "ok_rps": round(len(lat) / wall, 2) if wall else 0.0,
+        "p50_ms": round(1000 * _percentile(lat, 0.50), 1),
+        "p95_ms": round(1000 * _percentile(lat, 0.95), 1),
+        "p99_ms": round(1000 * _percentile(lat, 0.99), 1),
+        "status": {str(k): v for k, v in codes.items()},
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--url", required=True)
+    ap.add_argument("--concurrency", type=int, default=8)
+    ap.add_argument("--duration", type=float, default=30.0)
+    ap.add_argument("--text", default="sofa, 3-Seater, red")
+    ap.add_argument("--type", default="sofa")
+    ap.add_argument("--k", type=int, default=24)
+    ap.add_argument("--image", help="Optional room photo to send as image_b64")
+    main(ap.parse_args())
@@ -0,0 +1,201 @@
+# mirror.py
+"""
+Local mirror of the Firestore `products` collection for image hydration.
+
+The mirror is filled by an on_snapshot listener (falling back to a one-off
+stream() read if the first snapshot is slow) and keeps, per product, the
+raw image candidate list for every color / color+size option. Looking up a
+product's images is then a dictionary access with no network I/O; the
+caller still signs gs:// URLs.
+
+Listeners added with add_listener(fn) are called as fn(pid, data_or_None)
+for every change after the initial snapshot (app.py uses this to feed
+online index updates).
+
+The collection only needs .on_snapshot(callback) and .stream(), so tests can
+drive it with an in-memory fake or the Firestore emulator.
+"""
+import threading, time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from filters import _norm_token
+
+
+def _match_key(keys, pref: str) -> Optional[str]:
+    """First key whose token equals the preference's token."""
+    want = _norm_token(pref)
+    for k in keys:
+        if _norm_token(k) == want:
+            return k
+    return None
+
+
+def _ordered_candidates(d: dict, color_key: Optional[str], size_key: Optional[str]) -> List[str]:
+    """Candidate list for already-resolved imagesByOption keys (None: no match)."""
+    candidates: List[str] = []
+
+    ibo = d.get("imagesByOption")
+    if isinstance(ibo, dict) and color_key and isinstance(ibo.get(color_key), dict):
+        size_map = ibo[color_key]
+        if size_key and isinstance(size_map.get(size_key), list):
+            for u in size_map[size_key]:
+                if isinstance(u, str):
+                    candidates.append(u)
+        else:
+            for arr in size_map.values():
+                if isinstance(arr, list):
+                    candidates.extend([u for u in arr if isinstance(u, str)])
+
+    if isinstance(ibo, dict):
+        for color_map in ibo.values():
+            if isinstance(color_map, dict):
+                for arr in color_map.values():
+                    if isinstance(arr, list):
+                        candidates.extend([u for u in arr if isinstance(u, str)])
+
+    for k in ("thumbnail","imageUrl","image","defaultImagePath","heroImage"):
+        v = d.get(k)
+        if isinstance(v, str):
+            candidates.append(v)
+    imgs = d.get("images")
+    if isinstance(imgs, list):
+        candidates.extend([u for u in imgs if isinstance(u, str)])
+    return candidates
+
+
+def image_candidates(d: dict, color_pref: Optional[str] = None, size_pref: Optional[str] = None) -> List[str]:
+    """Raw (unsigned) image URLs of a product dict, preferred option first."""
+    color_key = size_key = None
+    ibo = d.get("imagesByOption")
+    if isinstance(ibo, dict) and color_pref:
+        color_key = _match_key(ibo.keys(), color_pref)
+        if color_key is not None and isinstance(ibo[color_key], dict) and size_pref:
+            size_key = _match_key(ibo[color_key].keys(), size_pref)
+    return _ordered_candidates(d, color_key, size_key)
+
+
+_Key = Tuple[Optional[str], Optional[str]]
+
+
+def _precompute(d: dict) -> Dict[_Key, List[str]]:
+    """
+    Candidate lists keyed by (color token, size token), None meaning "no
+    preference given or nothing matched": (None, None) is the default
+    order and (color, None) covers "color matched, size did not". Tokens
+    may be "" (a key like "--"), which a preference like "-" still matches.
+    """
+    out: Dict[_Key, List[str]] = {(None, None): _ordered_candidates(d, None, None)}
+    ibo = d.get("imagesByOption")
+    if not isinstance(ibo, dict):
+        return out
+    for ck, size_map in ibo.items():
+        cn = _norm_token(ck)
+        if (cn, None) in out:
+            continue   # first matching key wins, as in image_candidates
+        out[(cn, None)] = _ordered_candidates(d, ck, None)
+        if isinstance(size_map, dict):
+            for sk in size_map.keys():
+                sn = _norm_token(sk)
+                if (cn, sn) not in out:
+                    out[(cn, sn)] = _ordered_candidates(d, ck, sk)
+    return out
+
+
+class ProductMirror:
+    """In-memory, listener-maintained copy of product image candidates."""
+
+    def __init__(self, collection):
+        self.collection = collection
+        self._products: Dict[str, Dict[_Key, List[str]]] = {}
+        self._lock = threading.Lock()
+        self._ready = threading.Event()
+        self._watch = None
+        self._listeners: List[Callable[[str, Optional[dict]], None]] = []
+        self._snapshots = 0
+        self.updates = 0
+        self.last_update = 0.0
+
+    # ---------- lifecycle ----------
+
+    def start(self, timeout: float = 30.0) -> bool:
+        """Attach the listener and wait for the initial snapshot; returns readiness."""
+        try:
+            self._watch = self.collection.on_snapshot(self._on_snapshot)
+        except Exception as e:
+            print(f"Product mirror listener failed: {e}")
+        if not self._ready.wait(timeout):
+            self.seed()
+        return self.ready
+
+    def seed(self):
+        """Full read of the collection (fallback when no snapshot arrives)."""
+        try:
+            for snap in self.collection.stream():
+                self.apply(snap.id, snap.to_dict() or {})
+            self._ready.set()
+        except Exception as e:
+            print(f"Product mirror seed failed: {e}")
+
+    def stop(self):
+        if self._watch is not None:
+            self._watch.unsubscribe()
+            self._watch = None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def add_listener(self, fn: Callable[[str, Optional[dict]], None]):
+        """Call fn(pid, data_or_None) on each change after the initial snapshot; keep it non-blocking."""
+        self._listeners.append(fn)
+
+    # ---------- updates ----------
+
+    def apply(self, pid: str, data: Optional[dict]):
+        """Insert/replace a product (data dict) or remove it (data=None)."""
+        entry = _precompute(data) if data is not None else None
+        with self._lock:
+            if entry is None:
+                self._products.pop(pid, None)
+            else:
+                self._products[pid] = entry
+            self.updates += 1
+            self.last_update = time.time()
+
+    def _on_snapshot(self, col_snapshot, changes, read_time):
+        # the listener's first snapshot is the current state, not a change
+        # (even when seed() already made the mirror ready)
+        notify = self._snapshots > 0
+        self._snapshots += 1
+        for ch in changes:
+            doc = ch.document
+            data = None if getattr(ch.type, "name", str(ch.type)) == "REMOVED" else (doc.to_dict() or {})
+            self.apply(doc.id, data)
+            if notify:
+                for fn in self._listeners:
+                    fn(doc.id, data)
+        self._ready.set()
+
+    # ---------- lookup ----------
+
+    def candidates(self, pid: str, color_pref: Optional[str] = None, size_pref: Optional[str] = None) -> Optional[List[str]]:
+        """Raw candidates for a product, or None if it is not in the mirror."""
+        with self._lock:
+            entry = self._products.get(pid)
+        if entry is None:
+            return None
+        if not color_pref:
+            return entry[(None, None)]
+        cn = _norm_token(color_pref)
+        if size_pref and (cn, _norm_token(size_pref)) in entry:
+            return entry[(cn, _norm_token(size_pref))]
+        return entry.get((cn, None), entry[(None, None)])
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "ready": self.ready,
+                "products": len(self._products),
+                "updates": self.updates,
+                "last_update": self.last_update,
+            }
@@ -1,12 +1,156 @@
 # model.py
-import json, os, io, base64
+import json, os, io, base64, threading, time
+from contextlib import contextmanager
 from typing import List, Dict, Tuple, Optional
 
 import faiss
+import numpy as np
 import torch
 import clip
 from PIL import Image
 
+from catalog import as_idmap, idmap_index, item_slugs, partition_file
+
+
+# Type chips offered by the guided form (FloatingRobot TYPES).
+GUIDED_TYPES = ["Bed", "Sofa", "Table", "Chair", "Sectional", "Ottoman", "Bench"]
+
+# Size / color chips per type of the guided form (FloatingRobot
+# TYPE_QUESTIONS). The form sends these verbatim ("1 seater"), which the
+# catalog labels ("1-Seater") do not cover; types without a color question
+# have no colors.
+_FORM_COLORS = ["Red", "White", "Black", "Brown"]
+GUIDED_FORM: Dict[str, Tuple[List[str], List[str]]] = {
+    "Sofa": (["1 seater", "2 seater", "3 seater", "4 seater", "5 seater"], _FORM_COLORS),
+    "Sectional": (["L-shape small", "L-shape large", "U-shape"], _FORM_COLORS),
+    "Chair": (["Standard", "Counter", "Bar"], _FORM_COLORS),
+    "Table": (["2 people", "4 people", "6 people", "8 people"], []),
+    "Bed": (["Single", "Double", "Queen", "King"], _FORM_COLORS),
+    "Bench": (["Short", "Medium", "Long"], []),
+    "Ottoman": (["Small", "Medium", "Large"], _FORM_COLORS),
+}
+
+FALLBACK_QUERY = "furniture"
+
+
+def normalize_query_text(text: str) -> str:
+    """Cache key for a text query; CLIP lower-cases and collapses whitespace itself."""
+    return " ".join((text or "").lower().split())
+
+
+def _option_label(o) -> Optional[str]:
+    v = (o.get("label") or o.get("name") or o.get("id")) if isinstance(o, dict) else o
+    return v.strip() if isinstance(v, str) and v.strip() else None
+
+
+def canonical_query_texts(mapping: Optional[List[dict]] = None) -> List[str]:
+    """
+    Enumerate the text queries the guided form can produce.
+
+    The form sends "<type>[, <size>][, <color>]" with the size and color
+    chips of that type (GUIDED_FORM). With a mapping, each catalog baseType
+    (singular, as the form names types) also gets the sizeOptions / colorOptions of its own
+    rows, so the count grows with the options per type, not with the product
+    of the whole catalog vocabulary.
+    """
+    # type -> (sizes, colors), each de-duplicated by normalized text
+    vocab: Dict[str, Tuple[Dict[str, str], Dict[str, str]]] = {}
+
+    def add_vocab(t: str, sizes, colors):
+        tv = vocab.setdefault(normalize_query_text(t), ({}, {}))
+        for d, values in zip(tv, (sizes, colors)):
+            for v in values:
+                if v:
+                    d.setdefault(normalize_query_text(v), v)
+
+    for t in GUIDED_TYPES:
+        add_vocab(t, *GUIDED_FORM.get(t, ([], [])))
+    for m in mapping or []:
+        bt = m.get("baseType")
+        if not isinstance(bt, str) or not bt.strip():
+            continue
+        sizes = [_option_label(o) for o in m.get("sizeOptions") or []]
+        colors = [_option_label(o) for o in m.get("colorOptions") or []]
+        add_vocab(bt.strip().rstrip("s"), sizes, colors)
+
+    out, seen = [], set()
+
+    def add(*parts):
+        key = normalize_query_text(", ".join(parts))
+        if key and key not in seen:
+            seen.add(key)
+            out.append(key)
+
+    add(FALLBACK_QUERY)
+    for t, (sizes, colors) in vocab.items():
+        add(t)
+        for sz in sizes:
+            add(t, sz)
+            for c in colors:
+                add(t, sz, c)
+        for c in colors:
+            add(t, c)
+    return out
+
+
+class _RWLock:
+    """Many concurrent readers (searches) or one writer (online updates); writers go first."""
+
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if not self._readers:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+# IndexIDMap2 keeps an int64 id per vector plus a reverse hash entry (~32 B)
+_ID_MAP_BYTES = 8
+_REV_MAP_BYTES = 32
+
+
+def _index_bytes(idx) -> int:
+    """Vector storage from ntotal * code size (no copy, unlike serialize_index)."""
+    if idx is None:
+        return 0
+    n = int(idx.ntotal)
+    extra = 0
+    if isinstance(idx, faiss.IndexIDMap2):
+        extra = n * (_ID_MAP_BYTES + _REV_MAP_BYTES)
+        idx = faiss.downcast_index(idx.index)
+    elif isinstance(idx, faiss.IndexIDMap):
+        extra = n * _ID_MAP_BYTES
+        idx = faiss.downcast_index(idx.index)
+    return n * int(idx.sa_code_size()) + extra
+
 
 class ArtifactIndex:
     """
@@ -16,23 +160,52 @@ class ArtifactIndex:
       artifacts/
         - products.faiss
         - mapping.json
+        - partitions.json        (optional: slug -> global rows)
+        - partitions/<slug>.faiss (optional: one sub-index per slug)
+
+    With mode="sq" (index_builder --quantize) the scalar-quantized
+    products.sq.faiss / partitions/<slug>.sq.faiss are loaded instead and
+    vectors.f32 is memory-mapped for exact reranking in FaissSearcher.
+
+    Indexes are held as IndexIDMap2 with id = mapping row (plain indexes
+    from older artifacts are wrapped on load), so in flat mode upsert() /
+    remove() can change products in place. Removed rows stay in
+    mapping_list as empty dicts until the next full load.
     """
 
-    def __init__(self, artifacts_dir: str = "artifacts"):
+    def __init__(self, artifacts_dir: str = "artifacts", mode: Optional[str] = None):
         self.art_dir = artifacts_dir
-        self.faiss_path = os.path.join(self.art_dir, "products.faiss")
+        self.mode = (mode or os.getenv("INDEX_MODE", "flat")).lower()
+        suffix = ".sq.faiss" if self.mode == "sq" else ".faiss"
+        self.index_suffix = suffix
+        self.faiss_path = os.path.join(self.art_dir, "products" + suffix)
         self.mapping_path = os.path.join(self.art_dir, "mapping.json")
+        self.vectors_path = os.path.join(self.art_dir, "vectors.f32")
+        self.exact: Optional[np.ndarray] = None  # (N, D) float32 memmap, sq mode only
 
         self.index: Optional[faiss.Index] = None
         self.mapping_list: List[dict] = []  # same order as FAISS rows
         self.id2row: Dict[str, int] = {}
 
+        self.partitions_path = os.path.join(self.art_dir, "partitions.json")
+        self.partitions: Dict[str, faiss.Index] = {}
+        self.partition_rows: Dict[str, np.ndarray] = {}  # global rows held by each slug
+        self.partitioned = False
+        self.lock = _RWLock()
+
     def load(self):
         """Load FAISS index + mapping from disk."""
         if not (os.path.exists(self.faiss_path) and os.path.exists(self.mapping_path)):
-            raise FileNotFoundError("artifacts not found (products.faiss / mapping.json).")
+            raise FileNotFoundError(f"artifacts not found ({os.path.basename(self.faiss_path)} / mapping.json).")
+
+        index = faiss.read_index(self.faiss_path)
+        self.index = as_idmap(index, np.arange(index.ntotal))
 
-        self.index = faiss.read_index(self.faiss_path)
+        self.exact = None
+        if self.mode == "sq" and os.path.exists(self.vectors_path):
+            self.exact = np.memmap(
+                self.vectors_path, dtype=np.float32, mode="r", shape=(self.index.ntotal, self.index.d)
+            )
 
         with open(self.mapping_path, "r", encoding="utf-8") as f:
             self.mapping_list = json.load(f)
@@ -40,10 +213,37 @@ class ArtifactIndex:
         # Map product id -> row index
         self.id2row = {m["id"]: i for i, m in enumerate(self.mapping_list) if "id" in m}
 
+        self._load_partitions()
+
+    def _load_partitions(self):
+        """Load per-category sub-indexes if index_builder wrote them."""
+        self.partitions, self.partition_rows = {}, {}
+        self.partitioned = os.path.exists(self.partitions_path)
+        if not self.partitioned:
+            return
+        with open(self.partitions_path, "r", encoding="utf-8") as f:
+            part_rows = json.load(f)
+        for slug, rows in part_rows.items():
+            path = os.path.join(self.art_dir, "partitions", partition_file(slug) + self.index_suffix)
+            if not os.path.exists(path):
+                continue
+            self.partitions[slug] = as_idmap(faiss.read_index(path), rows)
+            self.partition_rows[slug] = np.asarray(rows, dtype=np.int64)
+
     def size(self) -> int:
         """Number of vectors in the index."""
         return int(self.index.ntotal) if self.index is not None else 0
 
+    def memory_bytes(self) -> dict:
+        """Approximate resident bytes of the loaded indexes (memmap counted separately)."""
+        with self.lock.read():
+            return {
+                "mode": self.mode,
+                "index": _index_bytes(self.index),
+                "partitions": sum(_index_bytes(i) for i in self.partitions.values()),
+                "exact_mmap": int(self.exact.nbytes) if self.exact is not None else 0,
+            }
+
     def row_to_item(self, row: int) -> dict:
         """Return mapping entry for a given FAISS row index."""
         return self.mapping_list[row]
@@ -55,6 +255,66 @@ class ArtifactIndex:
             return None
         return self.mapping_list[i]
 
+    # ---------- online updates (flat mode) ----------
+
+    def vector(self, row: int) -> np.ndarray:
+        """Stored (D,) vector of a live row."""
+        with self.lock.read():
+            return self.index.reconstruct(int(row))
+
+    def upsert(self, item: dict, vec: np.ndarray) -> int:
+        """Insert or replace a product's mapping row and vector; returns its row."""
+        if self.exact is not None:
+            raise RuntimeError("online updates need a flat index (exact vectors are read-only)")
+        vec = np.ascontiguousarray(vec, dtype="float32").reshape(1, -1)
+        with self.lock.write():
+            row = self.id2row.get(item["id"])
+            if row is None:
+                row = len(self.mapping_list)
+                self.mapping_list.append(item)
+            else:
+                self._drop_row(row)
+                self.mapping_list[row] = item
+            ids = np.array([row], dtype=np.int64)
+            self.index.add_with_ids(vec, ids)
+            if self.partitioned:
+                for slug in item_slugs(item):
+                    if slug not in self.partitions:
+                        self.partitions[slug] = idmap_index(vec[:0], [])
+                        self.partition_rows[slug] = np.zeros(0, dtype=np.int64)
+                    self.partitions[slug].add_with_ids(vec, ids)
+                    self.partition_rows[slug] = np.append(self.partition_rows[slug], row)
+            self.id2row[item["id"]] = row
+        return row
+
+    def remove(self, pid: str) -> bool:
+        """Drop a product from every index; False if it was not indexed."""
+        with self.lock.write():
+            row = self.id2row.pop(pid, None)
+            if row is None:
+                return False
+            self._drop_row(row)
+            self.mapping_list[row] = {}
+        return True
+
+    def _drop_row(self, row: int):
+        sel = np.array([row], dtype=np.int64)
+        self.index.remove_ids(sel)
+        for slug in item_slugs(self.mapping_list[row]):
+            sub = self.partitions.get(slug)
+            if sub is not None:
+                sub.remove_ids(sel)
+                rows = self.partition_rows[slug]
+                self.partition_rows[slug] = rows[rows != row]
+
+    def snapshot(self) -> Tuple[np.ndarray, List[dict]]:
+        """Live vectors and mapping rows, renumbered densely (for compaction)."""
+        with self.lock.read():
+            ids = faiss.vector_to_array(self.index.id_map)
+            X = self.index.index.reconstruct_n(0, self.index.ntotal) if len(ids) else np.zeros((0, self.index.d), "float32")
+            order = np.argsort(ids)
+            return X[order], [self.mapping_list[int(i)] for i in ids[order]]
+
 
 class ClipQueryEncoder:
     """
@@ -66,11 +326,48 @@ class ClipQueryEncoder:
       - Mixture of both (weighted sum)
     """
 
-    def __init__(self, model_name: str = "ViT-B/32"):
+    def __init__(self, model_name: str = "ViT-B/32", model=None, preprocess=None):
         device = "cuda" if torch.cuda.is_available() else "cpu"
         self.device = device
-        self.model, self.preprocess = clip.load(model_name, device=device, jit=False)
+        if model is None:
+            self.model, self.preprocess = clip.load(model_name, device=device, jit=False)
+        else:
+            # Pre-built CLIP module (e.g. random weights for offline benchmarks)
+            self.model, self.preprocess = model.to(device), preprocess
         self.model.eval()
+        self.text_cache: Dict[str, torch.Tensor] = {}
+
+    def load_text_cache(self, path: str, encode_missing: bool = False) -> int:
+        """
+        Load precomputed vectors for canonical filter-only queries.
+
+        Reads the query_cache.npz written by index_builder. If it is missing
+        and encode_missing is set, only the guided-form strings (~100) are
+        encoded here, so startup cost does not grow with the catalog.
+        Returns the number of cached queries.
+        """
+        if os.path.exists(path):
+            with np.load(path, allow_pickle=False) as z:
+                keys, vecs = z["keys"].tolist(), z["vecs"]
+            self.text_cache = {
+                k: torch.from_numpy(vecs[i : i + 1].copy()) for i, k in enumerate(keys)
+            }
+        elif encode_missing:
+            keys = canonical_query_texts()
+            self.text_cache = {}
+            for i in range(0, len(keys), 256):
+                batch = keys[i : i + 256]
+                z = self._encode_texts(batch)
+                for j, k in enumerate(batch):
+                    self.text_cache[k] = z[j : j + 1]
+        return len(self.text_cache)
+
+    def _text_vec(self, text: str) -> torch.Tensor:
+        """Cached vector for canonical queries, CLIP text encoder otherwise."""
+        hit = self.text_cache.get(normalize_query_text(text))
+        if hit is not None:
+            return hit
+        return self._encode_texts([text])
 
     # ---------- helpers ----------
 
@@ -103,6 +400,7 @@ class ClipQueryEncoder:
         image_b64: Optional[str] = None,
         w_image: float = 0.7,
         w_text: float = 0.3,
+        image: Optional[Image.Image] = None,
     ) -> torch.Tensor:
         """
         Build a single query vector from optional text + optional image.
@@ -112,6 +410,7 @@ class ClipQueryEncoder:
           image_b64: Base64-encoded image of the room.
           w_image:   Weight for image embedding when both are present.
           w_text:    Weight for text embedding when both are present.
+          image:     Already-decoded RGB room photo; takes precedence over image_b64.
 
         Returns:
           A (1, D) torch.Tensor, L2-normalized, ready for FAISS.search().
@@ -120,9 +419,9 @@ class ClipQueryEncoder:
         vec_txt: Optional[torch.Tensor] = None
 
         # Image (room photo) branch
-        if image_b64:
+        if image is not None or image_b64:
             try:
-                pil = self._b64_to_pil(image_b64)
+                pil = image if image is not None else self._b64_to_pil(image_b64)
                 vec_img = self._encode_images([pil])
             except Exception:
                 # If anything goes wrong, silently ignore and fall back to text
@@ -130,11 +429,11 @@ class ClipQueryEncoder:
 
         # Text (preferences) branch
         if text:
-            vec_txt = self._encode_texts([text])
+            vec_txt = self._text_vec(text)
 
         # If nothing provided, use a neutral fallback
         if vec_img is None and vec_txt is None:
-            return self._encode_texts(["furniture"])
+            return self._text_vec(FALLBACK_QUERY)
 
         # Only one of them
         if vec_img is None:
@@ -147,29 +446,155 @@ class ClipQueryEncoder:
         q = q / q.norm(dim=-1, keepdim=True)
         return q
 
+    def embed_product(self, pil: Optional[Image.Image], fallback_text: str) -> np.ndarray:
+        """Catalog vector as index_builder makes it: the lead image, else the text fallback. Returns (D,) float32."""
+        z = self._encode_images([pil]) if pil is not None else self._encode_texts([fallback_text])
+        return z[0].numpy().astype("float32")
+
+
+class PoolOverloaded(Exception):
+    """Raised by InferencePool when a request cannot get a model slot in time."""
+
+    def __init__(self, reason: str, retry_after: int = 1):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class InferencePool:
+    """
+    Admission control for CPU-bound model calls.
+
+    At most `slots` calls run at once; up to `max_queue` more may wait, each
+    for at most `deadline_s`. Anything beyond that is rejected immediately
+    with PoolOverloaded so the server can answer 503 instead of piling up
+    threads. Torch intra-op threads are split evenly across the slots so
+    concurrent calls do not oversubscribe the cores.
+    """
+
+    def __init__(self, slots: int = 2, max_queue: int = 16, deadline_s: float = 5.0):
+        self.slots = max(1, int(slots))
+        self.max_queue = max(0, int(max_queue))
+        self.deadline_s = float(deadline_s)
+
+        self._sem = threading.BoundedSemaphore(self.slots)
+        self._lock = threading.Lock()
+        self._waiting = 0
+        self._in_flight = 0
+
+        self._served = 0
+        self._rejected_queue_full = 0
+        self._rejected_deadline = 0
+        self._wait_total_s = 0.0
+        self._wait_max_s = 0.0
+
+        torch.set_num_threads(max(1, (os.cpu_count() or 1) // self.slots))
+
+    def run(self, fn, *args, **kwargs):
+        """Call fn(*args, **kwargs) in a model slot, or raise PoolOverloaded."""
+        with self._lock:
+            if self._waiting >= self.max_queue and self._in_flight >= self.slots:
+                self._rejected_queue_full += 1
+                raise PoolOverloaded("queue full", retry_after=max(1, round(self.deadline_s)))
+            self._waiting += 1
+
+        t0 = time.perf_counter()
+        acquired = self._sem.acquire(timeout=self.deadline_s)
+        waited = time.perf_counter() - t0
+
+        with self._lock:
+            self._waiting -= 1
+            if not acquired:
+                self._rejected_deadline += 1
+            else:
+                self._in_flight += 1
+                self._served += 1
+                self._wait_total_s += waited
+                self._wait_max_s = max(self._wait_max_s, waited)
+        if not acquired:
+            raise PoolOverloaded("deadline exceeded", retry_after=max(1, round(self.deadline_s)))
+
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._sem.release()
+
+    def reject_queue_full(self) -> PoolOverloaded:
+        """Count and return a queue-full rejection decided before run() (e.g. by a full executor)."""
+        with self._lock:
+            self._rejected_queue_full += 1
+        return PoolOverloaded("queue full", retry_after=max(1, round(self.deadline_s)))
+
+    def stats(self) -> dict:
+        """Counters for health/debug endpoints."""
+        with self._lock:
+            served = self._served
+            return {
+                "slots": self.slots,
+                "max_queue": self.max_queue,
+                "deadline_s": self.deadline_s,
+                "torch_threads": torch.get_num_threads(),
+                "in_flight": self._in_flight,
+                "waiting": self._waiting,
+                "served": served,
+                "rejected_queue_full": self._rejected_queue_full,
+                "rejected_deadline": self._rejected_deadline,
+                "queue_wait_avg_ms": round(1000 * self._wait_total_s / served, 2) if served else 0.0,
+                "queue_wait_max_ms": round(1000 * self._wait_max_s, 2),
+            }
+
 
 class FaissSearcher:
-    """Thin wrapper to search your artifact index."""
+    """
+    Thin wrapper to search your artifact index.
 
-    def __init__(self, art: ArtifactIndex):
+    When the artifact index has exact float32 vectors (sq mode) the search is
+    two-stage: the quantized index returns k * rerank_factor candidates and
+    those are rescored exactly against the memory-mapped vectors.
+    """
+
+    def __init__(self, art: ArtifactIndex, rerank_factor: Optional[int] = None):
         self.art = art
+        self.rerank_factor = int(rerank_factor or os.getenv("RERANK_FACTOR", "4"))
 
-    def search(self, qvec: torch.Tensor, k: int) -> Tuple[List[int], List[float]]:
+    def _rerank(self, q: np.ndarray, rows: List[int], k: int) -> Tuple[List[int], List[float]]:
+        """Exact inner products for candidate rows, best k first."""
+        if not rows:
+            return [], []
+        order = np.argsort(rows)  # sorted reads are friendlier to the page cache
+        cand = np.asarray(rows, dtype=np.int64)[order]
+        exact = np.asarray(self.art.exact[cand], dtype=np.float32) @ q[0]
+        top = np.argsort(-exact)[:k]
+        return [int(cand[i]) for i in top], [float(exact[i]) for i in top]
+
+    def search(
+        self, qvec: torch.Tensor, k: int, partitions: Optional[List[str]] = None
+    ) -> Tuple[List[int], List[float]]:
         """
         Search the FAISS index.
 
         Args:
-          qvec: (1, D) query vector from ClipQueryEncoder.embed_query().
-          k:    Number of neighbors to retrieve.
+          qvec:       (1, D) query vector from ClipQueryEncoder.embed_query().
+          k:          Number of neighbors to retrieve.
+          partitions: Optional category slugs; when given, only those
+                      sub-indexes are scanned and their hits merged.
 
         Returns:
-          rows:   List of FAISS row indices (ints).
+          rows:   List of FAISS row indices (ints) into the global mapping.
           scores: Corresponding similarity scores (floats).
         """
+        if partitions:
+            return self._search_partitions(qvec, k, partitions)
+
         if self.art.index is None or self.art.size() == 0:
             return [], []
 
-        D, I = self.art.index.search(qvec.numpy().astype("float32"), k)
+        q = qvec.numpy().astype("float32")
+        k_scan = k * self.rerank_factor if self.art.exact is not None else k
+        with self.art.lock.read():
+            D, I = self.art.index.search(q, k_scan)
 
         # Filter out -1 entries if FAISS returns them
         rows_raw = I[0].tolist()
@@ -178,4 +603,28 @@ class FaissSearcher:
         rows = [i for i in rows_raw if i >= 0]
         scores = [float(scores_raw[j]) for j, i in enumerate(rows_raw) if i >= 0]
 
+        if self.art.exact is not None:
+            return self._rerank(q, rows, k)
         return rows, scores
+
+    def _search_partitions(
+        self, qvec: torch.Tensor, k: int, partitions: List[str]
+    ) -> Tuple[List[int], List[float]]:
+        """Top-k over the union of sub-indexes, de-duplicated by global row."""
+        q = qvec.numpy().astype("float32")
+        k_scan = k * self.rerank_factor if self.art.exact is not None else k
+        best: Dict[int, float] = {}
+        with self.art.lock.read():
+            for slug in partitions:
+                sub = self.art.partitions.get(slug)
+                if sub is None or sub.ntotal == 0:
+                    continue
+                D, I = sub.search(q, min(k_scan, int(sub.ntotal)))
+                for row, sc in zip(I[0].tolist(), D[0].tolist()):
+                    if row >= 0 and sc > best.get(row, float("-inf")):
+                        best[row] = float(sc)
+
+        if self.art.exact is not None:
+            return self._rerank(q, list(best), k)
+        top = sorted(best.items(), key=lambda x: x[1], reverse=True)[:k]
+        return [r for r, _ in top], [s for _, s in top]
@@ -0,0 +1,337 @@
+# online.py
+"""
+Online add / update / remove for the serving index.
+
+Changes go straight into the in-memory ArtifactIndex (flat mode only) and
+are appended to a write-ahead log next to the artifacts, so a restart
+replays them on top of the last build. Compaction writes the live catalog
+back out as products.faiss / mapping.json / partitions and empties the log;
+it runs after ONLINE_COMPACT_EVERY logged changes and every
+ONLINE_COMPACT_INTERVAL_S while changes are pending.
+
+WAL records, one JSON object per line, applied in order and keyed by
+product id (so replaying a record twice is harmless):
+  {"op": "upsert", "item": <mapping row>, "vec": <base64 float32>}
+  {"op": "remove", "id": <product id>}
+
+Each run of records starts with a header tying it to the artifacts it
+applies to (generation = hash of mapping.json, see catalog.py):
+  {"op": "header", "generation": <id>, "base": <id or null>}
+A run is replayed when its generation is the one on disk, or when its base
+is the generation of the run replayed just before it (records logged while
+a compaction was writing that generation). Anything else predates the
+current artifacts, e.g. after an index_builder rebuild, and is dropped.
+"""
+import base64, io, json, os, shutil, threading, time
+from typing import Callable, Optional
+
+import numpy as np
+from PIL import Image
+
+from catalog import (
+    artifact_generation, choose_lead_image, mapping_generation, mapping_row, normalize_gs,
+    text_fallback, write_artifacts, write_partitions,
+)
+from model import ArtifactIndex, ClipQueryEncoder, InferencePool
+
+ONLINE_COMPACT_EVERY = int(os.getenv("ONLINE_COMPACT_EVERY", "500"))
+ONLINE_COMPACT_INTERVAL_S = float(os.getenv("ONLINE_COMPACT_INTERVAL_S", "3600"))
+
+# Written by index_builder --quantize; stale once mapping.json is renumbered
+_SQ_ARTIFACTS = ("products.sq.faiss", "vectors.f32")
+
+
+def _vec_b64(vec: np.ndarray) -> str:
+    return base64.b64encode(np.ascontiguousarray(vec, dtype="<f4").tobytes()).decode("ascii")
+
+
+def _vec_from_b64(s: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(s), dtype="<f4").astype("float32")
+
+
+class OnlineIndex:
+    """
+    Applies product changes to a live ArtifactIndex and keeps them durable.
+
+    fetch_image(url) returns the lead image bytes (or None); embedding runs
+    through the inference pool so updates queue behind, not beside, search
+    traffic. on_change(pid, item_or_None) is called after each applied change.
+    gs:// image URLs are pointed at `bucket`, else <project>.appspot.com, as
+    index_builder does.
+    """
+
+    def __init__(
+        self,
+        art: ArtifactIndex,
+        encoder: ClipQueryEncoder,
+        pool: InferencePool,
+        fetch_image: Callable[[str], Optional[bytes]],
+        on_change: Optional[Callable[[str, Optional[dict]], None]] = None,
+        bucket: Optional[str] = None,
+        project: Optional[str] = None,
+        wal_path: Optional[str] = None,
+        compact_every: int = ONLINE_COMPACT_EVERY,
+        compact_interval_s: float = ONLINE_COMPACT_INTERVAL_S,
+    ):
+        if art.mode != "flat":
+            raise ValueError("online updates need INDEX_MODE=flat")
+        self.art, self.encoder, self.pool = art, encoder, pool
+        self.fetch_image = fetch_image
+        self.on_change = on_change
+        self.bucket = bucket or (f"{project}.appspot.com" if project else None)
+        self.wal_path = wal_path or os.path.join(art.art_dir, "delta.wal")
+        self.rotated_path = self.wal_path + ".compacting"
+        self.compact_every = max(1, int(compact_every))
+        self.compact_interval_s = float(compact_interval_s)
+
+        self._lock = threading.Lock()   # one writer: index and WAL see changes in the same order
+        self._wal = None
+        self._generation: Optional[str] = None   # of the WAL run being appended to
+        self._pending = 0               # logged changes not yet in the artifacts
+        self._compacting = False
+        self._stop = threading.Event()
+        self._timer: Optional[threading.Thread] = None
+
+        self.counters = {
+            "upserts": 0, "removes": 0, "replayed": 0, "stale": 0,
+            "vec_reused": 0, "vec_image": 0, "vec_text": 0, "compactions": 0,
+        }
+        self.last_compaction = 0.0
+
+    # ---------- lifecycle ----------
+
+    def replay(self) -> int:
+        """Re-apply logged changes (an interrupted compaction's log first) and open the WAL."""
+        current = artifact_generation(self.art.art_dir)
+        n = stale = 0
+        last = None   # generation of the last run applied
+        for path in (self.rotated_path, self.wal_path):
+            if not os.path.exists(path):
+                continue
+            ok = False    # records before any header are stale
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        break   # torn tail from a crash mid-append
+                    op = rec.get("op")
+                    if op == "header":
+                        gen = rec.get("generation")
+                        ok = gen == current or (last is not None and rec.get("base") == last)
+                        if ok:
+                            last = gen
+                    elif not ok:
+                        stale += 1
+                    elif op == "upsert":
+                        self.art.upsert(rec["item"], _vec_from_b64(rec["vec"]))
+                        n += 1
+                    elif op == "remove":
+                        self.art.remove(rec["id"])
+                        n += 1
+        if stale:
+            print(f"Online WAL: dropped {stale} record(s) logged against other artifacts")
+            if not n:
+                for path in (self.rotated_path, self.wal_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+        self._wal = open(self.wal_path, "a", encoding="utf-8")
+        self._generation = last or current
+        self._header(base=last)
+        self._pending = n
+        self.counters["replayed"] = n
+        self.counters["stale"] = stale
+        if n >= self.compact_every or os.path.exists(self.rotated_path):
+            self._compact_async()
+        return n
+
+    def start(self):
+        """Replay the WAL and start the periodic compaction thread."""
+        if self._wal is None:
+            self.replay()
+        if self._timer is None and self.compact_interval_s > 0:
+            self._timer = threading.Thread(target=self._compact_loop, name="online-compact", daemon=True)
+            self._timer.start()
+
+    def stop(self):
+        self._stop.set()
+        with self._lock:
+            if self._wal is not None:
+                self._wal.close()
+                self._wal = None
+
+    def _compact_loop(self):
+        while not self._stop.wait(self.compact_interval_s):
+            if self._pending:
+                self.compact()
+
+    # ---------- changes ----------
+
+    def upsert(self, product: dict) -> dict:
+        """
+        Index a Firestore product dict (product["id"] set). The stored vector
+        is reused when the lead image is unchanged, so metadata-only edits
+        (price, options, names) never run CLIP.
+        """
+        pid = product["id"]
+        lead = normalize_gs(choose_lead_image(product), self.bucket)
+        row = self.art.id2row.get(pid)
+        old = self.art.mapping_list[row] if row is not None else None
+
+        if old and old.get("image") == (lead or "") and old.get("avg_lab") is not None:
+            vec = self.art.vector(row)
+            item = {**mapping_row(product, lead, None), "avg_lab": old["avg_lab"]}
+            how = "reused"
+        else:
+            pil = self._load_image(lead)
+            vec = self.pool.run(self.encoder.embed_product, pil, text_fallback(product, pid))
+            item = mapping_row(product, lead, pil)
+            how = "image" if pil is not None else "text"
+
+        # serialize first: a row json cannot encode must fail before the index changes
+        line = self._record({"op": "upsert", "item": item, "vec": _vec_b64(vec)})
+        with self._lock:
+            self.art.upsert(item, vec)
+            self._log(line)
+            self.counters["upserts"] += 1
+            self.counters[f"vec_{how}"] += 1
+        if self.on_change is not None:
+            self.on_change(pid, item)
+        return {"id": pid, "op": "upsert", "vector": how}
+
+    def remove(self, pid: str) -> dict:
+        with self._lock:
+            removed = self.art.remove(pid)
+            if removed:
+                self._log(self._record({"op": "remove", "id": pid}))
+                self.counters["removes"] += 1
+        if removed and self.on_change is not None:
+            self.on_change(pid, None)
+        return {"id": pid, "op": "remove", "removed": removed}
+
+    def _load_image(self, url: Optional[str]) -> Optional[Image.Image]:
+        if not url:
+            return None
+        data = self.fetch_image(url)
+        if not data:
+            return None
+        try:
+            return Image.open(io.BytesIO(data)).convert("RGB")
+        except Exception:
+            return None
+
+    def _header(self, base: Optional[str]):
+        """Start a run of records for self._generation (caller holds _lock or is replaying)."""
+        self._wal.write(json.dumps({"op": "header", "generation": self._generation, "base": base}) + "\n")
+        self._wal.flush()
+        os.fsync(self._wal.fileno())
+
+    @staticmethod
+    def _record(rec: dict) -> str:
+        """One WAL line; raises TypeError for values JSON cannot hold."""
+        return json.dumps(rec, ensure_ascii=False) + "\n"
+
+    def _log(self, line: str):
+        """Append one serialized record durably (caller holds _lock)."""
+        if self._wal is None:
+            raise RuntimeError("OnlineIndex.replay() has not run")
+        self._wal.write(line)
+        self._wal.flush()
+        os.fsync(self._wal.fileno())
+        self._pending += 1
+        if self._pending >= self.compact_every:
+            self._compact_async()
+
+    # ---------- compaction ----------
+
+    def _compact_async(self):
+        if not self._compacting:
+            threading.Thread(target=self.compact, name="online-compact-now", daemon=True).start()
+
+    def compact(self) -> bool:
+        """
+        Write the live catalog as fresh artifacts and drop the logged changes.
+
+        The snapshot and the WAL rotation happen under the writer lock, so
+        changes arriving while the files are written land in the new WAL.
+        The in-memory index keeps its row numbers; only the files on disk
+        are renumbered.
+        """
+        with self._lock:
+            if self._compacting or self._wal is None:
+                return False
+            self._compacting = True
+            X, mapping = self.art.snapshot()
+            self._wal.close()
+            self._rotate()
+            self._wal = open(self.wal_path, "a", encoding="utf-8")
+            # new records apply on top of the snapshot being written
+            base, self._generation = self._generation, mapping_generation(mapping)
+            self._header(base=base)
+            folded = self._pending
+            self._pending = 0
+        try:
+            self._write_snapshot(X, mapping)
+            if os.path.exists(self.rotated_path):
+                os.remove(self.rotated_path)
+            self.counters["compactions"] += 1
+            self.last_compaction = time.time()
+            return True
+        except Exception as e:
+            print(f"Online compaction failed: {e}")
+            with self._lock:
+                self._pending += folded   # still only in the rotated log
+            return False
+        finally:
+            self._compacting = False
+
+    def _rotate(self):
+        if not os.path.exists(self.wal_path):
+            return
+        if os.path.exists(self.rotated_path):
+            # left by a failed compaction: keep its records ahead of the new ones
+            with open(self.rotated_path, "ab") as dst, open(self.wal_path, "rb") as src:
+                shutil.copyfileobj(src, dst)
+            os.remove(self.wal_path)
+        else:
+            os.replace(self.wal_path, self.rotated_path)
+
+    def _write_snapshot(self, X: np.ndarray, mapping: list):
+        art_dir = self.art.art_dir
+        tmp = os.path.join(art_dir, ".compact-tmp")
+        shutil.rmtree(tmp, ignore_errors=True)
+        write_artifacts(X, mapping, tmp)
+
+        if self.art.partitioned:
+            write_partitions(X, mapping, tmp)
+            part_dir = os.path.join(art_dir, "partitions")
+            old_dir = os.path.join(art_dir, ".partitions-old")
+            shutil.rmtree(old_dir, ignore_errors=True)
+            if os.path.exists(part_dir):
+                os.replace(part_dir, old_dir)
+            os.replace(os.path.join(tmp, "partitions"), part_dir)
+            os.replace(os.path.join(tmp, "partitions.json"), self.art.partitions_path)
+            shutil.rmtree(old_dir, ignore_errors=True)
+
+        for name in _SQ_ARTIFACTS:
+            path = os.path.join(art_dir, name)
+            if os.path.exists(path):
+                os.remove(path)
+        # Each file is swapped atomically, but not the set: a crash inside this
+        # window needs an index_builder run (the WAL is still intact).
+        os.replace(os.path.join(tmp, "products.faiss"), self.art.faiss_path)
+        os.replace(os.path.join(tmp, "mapping.json"), self.art.mapping_path)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            wal_bytes = os.path.getsize(self.wal_path) if os.path.exists(self.wal_path) else 0
+            return {
+                **self.counters,
+                "live": len(self.art.id2row),
+                "pending": self._pending,
+                "generation": self._generation,
+                "wal_bytes": wal_bytes,
+                "compacting": self._compacting,
+                "last_compaction": self.last_compaction,
+            }
@@ -0,0 +1,53 @@
+# scan.py
+"""
+Partitioned read of the active top-level `products` collection.
+
+Kept free of the model/storage dependencies so it can be exercised against
+an in-memory fake client (see selfcheck.py) or the Firestore emulator.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+
+def is_active_product(d) -> bool:
+    """Same predicate as .where("active", "==", True) on the top-level collection."""
+    ref = getattr(d, "reference", None)
+    parent = getattr(ref, "parent", None)
+    if parent is not None and getattr(parent, "parent", None) is not None:
+        return False   # a nested */products subcollection picked up by the group query
+    return (d.to_dict() or {}).get("active") is True
+
+
+def _read_partition(query) -> list:
+    return [d for d in query.stream() if is_active_product(d)]
+
+
+def iter_active_products(db, partitions: int = 4):
+    """
+    Yield active product snapshots in document-id order.
+
+    With partitions > 1 the collection is split with a Firestore partition
+    query and every partition is read on its own thread. Partitions are
+    yielded in key order, so the row order matches the sequential cursor
+    regardless of which reader finishes first. Falls back to the single
+    filtered cursor when partition queries are unavailable.
+    """
+    if partitions <= 1:
+        yield from db.collection("products").where("active", "==", True).stream()
+        return
+
+    try:
+        # Partition queries only exist on collection groups and cannot carry
+        # filters, so "active" is checked client-side in _read_partition.
+        queries = [p.query() for p in db.collection_group("products").get_partitions(partitions)]
+    except Exception as e:
+        print(f"Partition query unavailable ({e}); using a single cursor")
+        queries = []
+
+    if not queries:
+        yield from db.collection("products").where("active", "==", True).stream()
+        return
+
+    with ThreadPoolExecutor(max_workers=len(queries)) as pool:
+        futures = [pool.submit(_read_partition, q) for q in queries]
+        for fut in futures:
+            yield from fut.result()
@@ -0,0 +1,273 @@
+# selfcheck.py
+"""
+Offline checks of the Firestore-facing code against an in-memory fake client.
+
+  python selfcheck.py scan     # partitioned product scan vs the single cursor
+  python selfcheck.py mirror   # ProductMirror.candidates vs image_candidates
+  python selfcheck.py all
+
+Each check prints a JSON summary and the script exits non-zero on the
+first mismatch. Only the pure-Python modules are imported, so no model,
+FAISS or Google credentials are needed.
+"""
+import argparse, json, os, random, sys
+from types import SimpleNamespace
+
+
+# -----------------------------------------------------------------------------
+# In-memory Firestore fake
+# -----------------------------------------------------------------------------
+class _Ref:
+    def __init__(self, path: str):
+        self.path = path
+        parts = path.split("/")
+        # products/<id> -> parent collection has no parent document
+        self.parent = _Coll("/".join(parts[:-1]))
+
+
+class _Coll:
+    def __init__(self, path: str):
+        parts = path.split("/")
+        self.id = parts[-1]
+        self.parent = _Ref("/".join(parts[:-1])) if len(parts) > 1 else None
+
+
+class FakeDoc:
+    def __init__(self, path: str, data: dict):
+        self.id = path.rsplit("/", 1)[-1]
+        self.reference = _Ref(path)
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data)
+
+
+class _Query:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def where(self, field, op, value):
+        assert op == "=="
+        return _Query([d for d in self._docs if d.to_dict().get(field) == value])
+
+    def stream(self):
+        return iter(list(self._docs))
+
+
+class _Partition:
+    def __init__(self, docs):
+        self._docs = docs
+
+    def query(self):
+        return _Query(self._docs)
+
+
+class _Group:
+    def __init__(self, docs):
+        # collection-group queries order by full document path
+        self._docs = sorted(docs, key=lambda d: d.reference.path)
+
+    def get_partitions(self, n):
+        size = max(1, -(-len(self._docs) // n))
+        return [_Partition(self._docs[i : i + size]) for i in range(0, len(self._docs), size)]
+
+
+class FakeFirestore:
+    """db.collection(name) / db.collection_group(name) over a fixed set of documents."""
+
+    def __init__(self, docs):
+        self.docs = docs
+
+    def collection(self, name):
+        top = [d for d in self.docs if d.reference.path.count("/") == 1 and d.reference.path.startswith(name + "/")]
+        return _Query(sorted(top, key=lambda d: d.id))
+
+    def collection_group(self, name):
+        return _Group([d for d in self.docs if d.reference.parent.id == name])
+
+
+class FakeCollection:
+    """on_snapshot / stream over a dict of product docs; push() delivers a later snapshot."""
+
+    def __init__(self, products: dict):
+        self.products = dict(products)
+        self._callbacks = []
+
+    def _change(self, pid, data, kind):
+        doc = FakeDoc(f"products/{pid}", data if data is not None else {})
+        return SimpleNamespace(document=doc, type=SimpleNamespace(name=kind))
+
+    def on_snapshot(self, callback):
+        self._callbacks.append(callback)
+        callback(None, [self._change(pid, d, "ADDED") for pid, d in self.products.items()], None)
+        return SimpleNamespace(unsubscribe=lambda: self._callbacks.remove(callback))
+
+    def stream(self):
+        return iter([FakeDoc(f"products/{pid}", d) for pid, d in self.products.items()])
+
+    def push(self, pid, data):
+        kind = "REMOVED" if data is None else ("MODIFIED" if pid in self.products else "ADDED")
+        if data is None:
+            self.products.pop(pid, None)
+        else:
+            self.products[pid] = data
+        for cb in list(self._callbacks):
+            cb(None, [self._change(pid, data, kind)], None)
+
+
+def _fake_catalog(n: int, seed: int = 0):
+    """Top-level products (some inactive) plus nested */products noise."""
+    rng = random.Random(seed)
+    docs = []
+    for i in range(n):
+        pid = f"p{rng.randrange(10**8):08d}"
+        docs.append(FakeDoc(f"products/{pid}", {"name": pid, "active": rng.random() < 0.8}))
+    for i in range(n // 4):
+        # parents sorting before and after "products/" so group partitions interleave them
+        parent = ("brands", "stores")[i % 2]
+        docs.append(FakeDoc(f"{parent}/s{i % 3}/products/n{i:05d}", {"active": True}))
+    rng.shuffle(docs)
+    return docs
+
+
+def _option_labels(opts, key):
+    out = []
+    for o in opts or []:
+        v = o.get(key) if isinstance(o, dict) else o
+        if isinstance(v, str) and v:
+            out.append(v)
+    return out
+
+
+def _fake_products(mapping_path: str, n: int, seed: int = 0) -> dict:
+    """
+    Product docs with imagesByOption, built from the rows of mapping.json
+    when present (their color/size options) plus synthetic ones, including
+    keys that collide or vanish after token normalisation.
+    """
+    rng = random.Random(seed)
+    rows = []
+    if os.path.exists(mapping_path):
+        with open(mapping_path, "r", encoding="utf-8") as f:
+            rows = json.load(f)
+    colors = ["Red", "White", "Black", "Brown", "Navy Blue", "off-white"]
+    sizes = ["1 Seater", "2-Seater", "L-Shape (Large)", "Queen", "6 People", "Small"]
+    for i in range(max(0, n - len(rows))):
+        rows.append({
+            "id": f"syn{i:04d}",
+            "colorOptions": [{"name": c} for c in rng.sample(colors, rng.randint(0, 4))],
+            "sizeOptions": [{"label": s} for s in rng.sample(sizes, rng.randint(0, 3))],
+        })
+
+    products = {}
+    for r in rows:
+        pid = r["id"]
+        ibo = {}
+        for c in _option_labels(r.get("colorOptions"), "name"):
+            labels = _option_labels(r.get("sizeOptions"), "label")
+            ibo[c] = {s: [f"gs://b/{pid}/{c}/{s}/{k}.jpg" for k in range(rng.randint(0, 2))] for s in labels}
+            if not labels or rng.random() < 0.3:
+                ibo[c]["default"] = [f"gs://b/{pid}/{c}/default.jpg"]
+        if ibo and rng.random() < 0.3:
+            # a second key for an existing colour token ("Red" / "red ") and a
+            # key with no token at all: lookup must keep the first match
+            first = next(iter(ibo))
+            ibo[first.lower() + " "] = {"x": [f"gs://b/{pid}/dup.jpg"]}
+            ibo["--"] = {"--": [f"gs://b/{pid}/blank.jpg"]}
+        if ibo and rng.random() < 0.2:
+            ibo[next(iter(ibo))]["broken"] = "not-a-list"
+        d = {"name": pid, "thumbnail": f"gs://b/{pid}/thumb.jpg", "images": [f"gs://b/{pid}/0.jpg"]}
+        if ibo:
+            d["imagesByOption"] = ibo
+        elif rng.random() < 0.5:
+            d["imagesByOption"] = "legacy-string"
+        products[pid] = d
+    return products
+
+
+def _preferences(d: dict):
+    """None, every exact key pair, case/punctuation variants and misses."""
+    prefs = [(None, None), ("", ""), ("Chartreuse", None), (None, "Queen"), ("Chartreuse", "Queen"), ("--", None)]
+    ibo = d.get("imagesByOption")
+    if isinstance(ibo, dict):
+        for ck, size_map in ibo.items():
+            prefs += [(ck, None), (ck.upper(), None), (f" {ck.replace(' ', '-')}!", None), (ck, "Gigantic")]
+            if isinstance(size_map, dict):
+                for sk in size_map:
+                    prefs += [(ck, sk), (ck.lower(), sk.upper().replace(" ", "")), (ck, f"({sk})")]
+    return prefs
+
+
+# -----------------------------------------------------------------------------
+# Checks
+# -----------------------------------------------------------------------------
+def check_scan(n: int = 500) -> dict:
+    from scan import is_active_product, iter_active_products
+
+    db = FakeFirestore(_fake_catalog(n))
+    single = [d.id for d in iter_active_products(db, partitions=1)]
+    expected = sorted(
+        d.id for d in db.docs if d.reference.path.count("/") == 1 and d.to_dict().get("active") is True
+    )
+    assert single == expected, "single cursor differs from the filtered collection"
+
+    nested = [d for d in db.docs if d.reference.path.count("/") > 1]
+    assert nested and not any(is_active_product(d) for d in nested), "nested */products passed the filter"
+
+    out = {"check": "scan", "docs": len(db.docs), "active": len(expected), "nested": len(nested)}
+    for parts in (2, 3, 4, 7, 16):
+        got = [d.id for d in iter_active_products(db, partitions=parts)]
+        assert got == single, f"partitions={parts}: row order differs from the single cursor"
+        out[f"partitions_{parts}"] = "ok"
+    return out
+
+
+def check_mirror(n: int = 200) -> dict:
+    from mirror import ProductMirror, image_candidates
+
+    products = _fake_products(os.path.join("artifacts", "mapping.json"), n)
+    coll = FakeCollection(products)
+    mirror = ProductMirror(coll)
+    assert mirror.start(timeout=1.0), "mirror not ready after the initial snapshot"
+
+    def compare(pid, d):
+        k = 0
+        for c, s in _preferences(d):
+            got, want = mirror.candidates(pid, c, s), image_candidates(d, c, s)
+            assert got == want, f"{pid} color={c!r} size={s!r}: {got} != {want}"
+            k += 1
+        return k
+
+    lookups = sum(compare(pid, d) for pid, d in products.items())
+    assert mirror.candidates("missing") is None, "unknown product returned candidates"
+
+    # later snapshots: edits, removals and new products are applied and
+    # reach listeners; the initial snapshot did not
+    seen = []
+    mirror.add_listener(lambda pid, d: seen.append(pid))
+    pids = sorted(products)
+    edited, removed = pids[0], pids[1]
+    new = {**products[pids[2]], "thumbnail": "gs://b/new/thumb.jpg"}
+    coll.push(edited, {**products[edited], "images": ["gs://b/edited.jpg"]})
+    coll.push(removed, None)
+    coll.push("new0001", new)
+    assert seen == [edited, removed, "new0001"], f"listener saw {seen}"
+    lookups += compare(edited, coll.products[edited]) + compare("new0001", new)
+    assert mirror.candidates(removed) is None, "removed product still mirrored"
+
+    return {"check": "mirror", "products": len(products), "lookups": lookups, "listener": "ok"}
+
+
+CHECKS = {"mirror": check_mirror, "scan": check_scan}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("check", choices=sorted(CHECKS) + ["all"])
+    args = ap.parse_args()
+    for name in sorted(CHECKS) if args.check == "all" else [args.check]:
+        try:
+            print(json.dumps(CHECKS[name]()))
+        except AssertionError as e:
+            print(json.dumps({"check": name, "failed": str(e)}))
+            sys.exit(1)